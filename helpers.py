@@ -1,9 +1,297 @@
 import urllib.parse
 import re
 import os
-from bs4 import BeautifulSoup
+import hashlib
+import html
+import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from lxml import etree
 
-def fix_query_strings(domain: str, download_dir: str):
+# Extensions of the pages processed by normalize-html, php-rename and pretty-print
+_PAGE_EXTS = ('.html', '.htm', '.asp', '.php')
+
+# Below this many files the process pool start-up outweighs the parallel speedup
+_MIN_PARALLEL_FILES = 8
+
+# Size of the blocks in which fix-query reads the files it only has to search and replace in
+_CHUNK_SIZE = 65536
+
+# Worker processes shared by every caller of map_files, including the domains main processes
+# in parallel threads, so there are never more workers than CPUs. They are not forked from the
+# (threaded) main process, which could copy locks held by other threads and deadlock
+_pool = None
+_pool_lock = threading.Lock()
+
+# Common web page extensions (.asp.html and .php.html are covered by .html)
+_WEB_EXT_RE = re.compile(r'\.(html|htm|asp|php|jsp|aspx|do|cgi)$', re.IGNORECASE)
+# URLs hidden in JavaScript code like location.href='url'
+_LOCATION_HREF_RE = re.compile(r"location\.href\s*=\s*['\"]([^'\"]+)['\"]")
+# File names saved by wget with a doubled extension, e.g. page.asp.html
+_ASP_PHP_HTML_NAME_RE = re.compile(r'\.(asp|php)\.html$', re.IGNORECASE)
+# The same doubled extension inside a URL, optionally followed by a query or fragment
+_ASP_PHP_HTML_RE = re.compile(r'\.(asp|php)\.html($|\?|#)', re.IGNORECASE)
+_DOUBLE_SLASH_RE = re.compile(r'//+')
+# URLs that normalize_html does not resolve against the page directory: absolute paths (and //host),
+# anchors and templates are recognized by their first character, the rest by prefix
+_URL_SKIP_FIRST_CHARS = frozenset('/#{')
+_URL_SKIP_PREFIXES = ('http://', 'https://', 'javascript:', 'data:', 'mailto:', 'tel:')
+
+# Server-side code (PHP and ASP tags): the HTML parser would turn it into comments or escaped
+# text, so it is swapped for placeholders while a page is parsed, and put back once serialized.
+# Between tags a placeholder is a comment, which is allowed anywhere (even in <head>) and kept
+# verbatim; inside a tag it is made of lowercase letters and digits, which survive in attribute
+# values and names. A placeholder is keyed by a digest of the code, so the same code gets the
+# same placeholder in every page and block, and masked markup can be compared across files
+_SERVER_CODE_RE = re.compile(rb'<\?(?:php\b|=|\s).*?(?:\?>|\Z)|<%.*?(?:%>|\Z)', re.IGNORECASE | re.DOTALL)
+_SERVER_CODE_PLACEHOLDER = 'magicmirrorcode'
+_SERVER_CODE_PLACEHOLDER_RE = re.compile(rb'(?:<!--)?' + _SERVER_CODE_PLACEHOLDER.encode() + rb'([0-9a-f]{12})x(?:-->)?')
+
+# Pages with none of these tags are fragments (e.g. PHP include files), which are parsed
+# inside an added <html><body> and serialized without it
+_DOCUMENT_TAG_RE = re.compile(rb'<(?:html|head|body)[\s>]', re.IGNORECASE)
+
+# Partial pages (e.g. a header.php opening <div id="page"> that footer.php closes) have tags
+# the parser would close or drop, so they are never re-serialized. Comments and the content of
+# <script> and <style> are left out of the tag count
+_COMMENT_RE = re.compile(rb'<!--.*?(?:-->|\Z)', re.DOTALL)
+_RAW_TEXT_RE = re.compile(rb'(<(script|style)\b[^>]*>).*?(</\2\s*>|\Z)', re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(rb'<(/?)([a-zA-Z][\w:-]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>')
+# Elements without content, and elements whose end tag may be omitted
+_VOID_TAGS = frozenset(b'area base basefont br col embed frame hr img input isindex keygen link meta param '
+                       b'source track wbr'.split())
+_OPTIONAL_END_TAGS = frozenset(b'html head body p li dt dd option optgroup tr td th thead tbody tfoot colgroup '
+                               b'caption rb rt rtc rp'.split())
+
+# Characters replaced in the domain to name its pretty print cache file
+# (e.g. https://www.example.org/blog -> www.example.org_blog.json)
+_CACHE_NAME_RE = re.compile(r'[^\w.-]+')
+
+# Pages are parsed and serialized with lxml directly; pages without a doctype keep having none
+HTML_PARSER = etree.HTMLParser(encoding='utf-8', default_doctype=False)
+
+# Elements carrying at least one of the attributes listed in $names, so check_attrs searches
+# inside lxml instead of over every tag in Python. The user-entered names are passed as a
+# variable (space-separated, with a space at both ends) rather than written into the
+# expression, where names like "xlink:href" would not compile
+_ATTRS_XPATH = etree.XPath("//*[@*[contains($names, concat(' ', name(), ' '))]]")
+
+def iter_files(root: str, exts=None):
+    """
+    Recursively yields the files below a directory. Unlike os.walk, directories are read
+    with os.scandir in filesystem order, without sorting or materializing their listings,
+    and the file type comes from the directory entry, so no extra stat call is needed.
+    Directories that cannot be read are skipped, as os.walk does.
+
+    Args:
+        root (str): Directory to scan
+        exts (str | tuple, optional): Only yield files whose name ends with one of these suffixes
+
+    Yields:
+        str: Path of each matching file
+    """
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif exts is None or entry.name.endswith(exts):
+                    yield entry.path
+
+def _select_files(download_dir: str, files=None, exts=None):
+    """
+    Returns the files a helper works on: the given list when the caller has already
+    enumerated the download directory, otherwise a fresh walk of it.
+
+    Args:
+        download_dir (str): Directory containing the downloaded website files
+        files (list, optional): Paths of all the files below download_dir
+        exts (str | tuple, optional): Only return files whose name ends with one of these suffixes
+
+    Returns:
+        iterable: Paths of the matching files
+    """
+    if files is None:
+        return iter_files(download_dir, exts)
+    if exts is None:
+        return files
+    return [path for path in files if path.endswith(exts)]
+
+def _worker_pool() -> ProcessPoolExecutor:
+    """
+    Returns the shared pool of worker processes, starting it on first use. Workers are started
+    with forkserver, or spawn where it is not available.
+
+    Returns:
+        ProcessPoolExecutor: The pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                        mp_context=multiprocessing.get_context(method))
+        return _pool
+
+def map_files(func, paths):
+    """
+    Applies func to every path, spreading the files over the shared pool of worker processes.
+    HTML parsing is CPU-bound and holds the GIL, so processes are used instead of threads.
+    Short lists are handled in-process, where the pool start-up would cost more than it saves.
+
+    Args:
+        func (callable): Picklable (module-level) function taking a file path
+        paths (iterable): Paths of the files to process
+
+    Yields:
+        The result of func for each path, in the order of paths
+    """
+    paths = list(paths)
+    if len(paths) < _MIN_PARALLEL_FILES:
+        yield from map(func, paths)
+        return
+    workers = os.cpu_count() or 1
+    chunksize = max(1, min(32, len(paths) // (workers * 4)))
+    yield from _worker_pool().map(func, paths, chunksize=chunksize)
+
+def _rename_query_files(download_dir: str, files=None):
+    """
+    Renames the files with a query string in their name as described in fix_query_strings.
+
+    Args:
+        download_dir (str): Directory containing the downloaded website files
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
+
+    Returns:
+        tuple: (old_refs_re, byte_mapping, fixed_files): the bytes regex matching the old names
+            (None if no file was renamed), the old name -> new name mapping as bytes, and the
+            paths of all the files once the renames are done
+    """
+    # fix_mapping: map (relative old name with '@' -> new name "clean")
+    fix_mapping = {}
+    # Files left once the renames are done, which are the ones whose references are fixed
+    fixed_files = []
+    # The renames are planned first and done in one batch, so the tree is not modified
+    # while it is being listed
+    to_remove = []
+    to_rename = []
+    # Clean names taken by a rename planned earlier in the listing
+    planned_paths = set()
+    for old_full_path in list(_select_files(download_dir, files)):
+        root, file = os.path.split(old_full_path)
+        if "@" not in file:
+            fixed_files.append(old_full_path)
+        else:
+            # New name: take the part before the '@'
+            new_file_name = file.split("@")[0]
+            new_full_path = os.path.join(root, new_file_name)
+            # If a "clean" version of the file already exists, delete the one with '@'
+            if new_full_path in planned_paths or os.path.exists(new_full_path):
+                to_remove.append(old_full_path)
+            else:
+                to_rename.append((old_full_path, new_full_path))
+                planned_paths.add(new_full_path)
+                fixed_files.append(new_full_path)
+            # Save only the old and new names (without the path)
+            fix_mapping[file] = new_file_name
+
+    # The listing keeps the files of a directory together, so the batch works
+    # through one directory at a time
+    for old_full_path in to_remove:
+        os.remove(old_full_path)
+    for old_full_path, new_full_path in to_rename:
+        os.rename(old_full_path, new_full_path)
+
+    if not fix_mapping:
+        return None, {}, fixed_files
+
+    # The references are replaced on the raw bytes, so the files are never decoded
+    byte_mapping = {old_ref.encode("utf-8"): new_ref.encode("utf-8") for old_ref, new_ref in fix_mapping.items()}
+    # A single alternation finds every old reference in one scan of each file;
+    # longer names come first so they win over names that are their prefix
+    old_refs_re = re.compile(b"|".join(re.escape(old_ref) for old_ref in sorted(byte_mapping, key=len, reverse=True)))
+    return old_refs_re, byte_mapping, fixed_files
+
+def _iter_query_fixed(f, ctx: dict):
+    """
+    Reads a file in blocks of _CHUNK_SIZE bytes and yields its content with the old references
+    replaced, as a single substitution over the whole file would. The end of each block that
+    could be the start of a reference continuing in the next block is held back until then.
+
+    Args:
+        f (file): The file, opened in binary mode
+        ctx (dict): 'query_refs_re', 'query_refs' and 'query_refs_len', see apply_transforms
+
+    Yields:
+        bytes: The successive parts of the fixed content
+    """
+    query_refs_re, query_refs = ctx['query_refs_re'], ctx['query_refs']
+    held = ctx['query_refs_len'] - 1
+    tail = b''
+    while chunk := f.read(_CHUNK_SIZE):
+        buf = tail + chunk
+        # References starting before limit are entirely in buf
+        limit = len(buf) - held
+        parts = []
+        pos = 0
+        for match in query_refs_re.finditer(buf):
+            if match.start() >= limit:
+                break
+            parts += [buf[pos:match.start()], query_refs[match.group(0)]]
+            pos = match.end()
+        cut = max(pos, limit)
+        parts.append(buf[pos:cut])
+        tail = buf[cut:]
+        yield b''.join(parts)
+    yield query_refs_re.sub(lambda m: query_refs[m.group(0)], tail)
+
+def _fix_query_file(path: str, ctx: dict) -> bool:
+    """
+    Replaces the old references in a file without reading it into memory: the file is searched
+    block by block, and only a file containing a reference is rewritten, through a temporary file.
+
+    Args:
+        path (str): Path of the HTML or CSS file
+        ctx (dict): 'query_refs_re', 'query_refs' and 'query_refs_len', see apply_transforms
+
+    Returns:
+        bool: True if the file was rewritten
+    """
+    query_refs_re = ctx['query_refs_re']
+    held = ctx['query_refs_len'] - 1
+    with open(path, 'rb') as f:
+        tail = b''
+        while chunk := f.read(_CHUNK_SIZE):
+            buf = tail + chunk
+            if query_refs_re.search(buf):
+                break
+            tail = buf[-held:] if held else b''
+        else:
+            return False
+
+        f.seek(0)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.fix-query-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for part in _iter_query_fixed(f, ctx):
+                    out.write(part)
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return True
+
+def fix_query_strings(domain: str, download_dir: str, files=None):
     """
     Cleans up files with query strings in their names by removing the '@' and subsequent characters.
     For example, 'page@param=value.html' becomes 'page.html'. Also updates all references to these
@@ -15,37 +303,9 @@ def fix_query_strings(domain: str, download_dir: str):
     Args:
         domain (str): The website domain (not used in current implementation)
         download_dir (str): Directory containing the downloaded website files
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
     """
-    # fix_mapping: map (relative old name with '@' -> new name "clean")
-    fix_mapping = {}
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if "@" in file:
-                old_full_path = os.path.join(root, file)
-                # New name: take the part before the '@'
-                new_file_name = file.split("@")[0]
-                new_full_path = os.path.join(root, new_file_name)
-                # If a "clean" version of the file already exists, delete the one with '@'
-                if os.path.exists(new_full_path):
-                    os.remove(old_full_path)
-                else:
-                    os.rename(old_full_path, new_full_path)
-                # Save only the old and new names (without the path)
-                fix_mapping[file] = new_file_name
-
-    # Step 5: Correct references in files
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith(".html") or file.endswith(".css"):
-                file_path = os.path.join(root, file)
-                print(f"Processing {file_path}...")
-                with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                    content = f.read()
-                # Replace each old reference with the new one
-                for old_ref, new_ref in fix_mapping.items():
-                    content = content.replace(old_ref, new_ref)
-                with open(file_path, "w", encoding="utf-8", errors="ignore") as f:
-                    f.write(content)
+    apply_transforms(domain, download_dir, {"fix-query"}, files)
 
 def is_probably_url(value: str) -> bool:
     """
@@ -54,134 +314,684 @@ def is_probably_url(value: str) -> bool:
       - it doesn't contain spaces and
       - starts with "http://", "https://", "/", "./", "../"
         or contains a slash "/" or ends with common web extensions (.html, .asp, .php, etc.).
+      - or has a URL scheme (e.g. "mailto:").
     Otherwise returns False.
+
+    The cheapest tests run first, since this is called for every scanned attribute value.
     """
     if not value or ' ' in value:
         return False
-    parsed = urllib.parse.urlparse(value)
-    # If it's an absolute URL (has a scheme) return True.
-    if parsed.scheme:
-        return True
-    if value.startswith(("//", "http://", "https://", "/", "./", "../")):
-        return True
+    # Absolute, protocol-relative and relative paths ("//", "http://", "/", "./", "../")
+    # all contain a slash
     if "/" in value:
         return True
     # Check for common web file extensions
-    if re.search(r'\.(html|htm|asp|php|jsp|aspx|do|cgi)$', value, flags=re.IGNORECASE):
+    if value.endswith('.html') or _WEB_EXT_RE.search(value):
         return True
-    if re.search(r'\.(asp|php)\.html$', value, flags=re.IGNORECASE) or re.search(r'\.html$', value, flags=re.IGNORECASE):
-        return True
-    return False
+    # Only values with a colon can have a scheme, so urlparse is rarely needed
+    if ':' not in value:
+        return False
+    return bool(urllib.parse.urlparse(value).scheme)
 
-def check_attrs(domain: str, download_dir: str, attrs: str) -> set:
+def replace_attr_value(content: str, attr: str, old_value: str, new_value: str) -> str:
     """
-    Checks for URLs in specified attributes of HTML files and adds them to the list of extra URLs.
-    Also transforms absolute URLs that include the current domain into site-relative URLs.
-    Also extracts URLs hidden in JavaScript code within attributes like onclick="location.href='url'".
+    Replaces the value of an attribute directly in raw markup, without re-serializing
+    the document. Double-quoted, single-quoted and unquoted values are handled, as well
+    as values whose special characters were written as HTML entities.
 
     Args:
+        content (str): The raw HTML markup
+        attr (str): Name of the attribute
+        old_value (str): The current (decoded) value of the attribute
+        new_value (str): The value to write instead
+
+    Returns:
+        str: The markup with every matching attribute updated
+    """
+    for raw_old, raw_new in {(old_value, new_value),
+                             (html.escape(old_value, quote=False), html.escape(new_value, quote=False))}:
+        value = re.escape(raw_old)
+        pattern = re.compile(rf'(?<=\s)({re.escape(attr)}\s*=\s*)(?:"{value}"|\'{value}\'|{value}(?=[\s>]))',
+                             flags=re.IGNORECASE)
+        content = pattern.sub(lambda m: m.group(1) + m.group(0)[len(m.group(1)):].replace(raw_old, raw_new, 1), content)
+    return content
+
+def _check_attrs_file(file_path: str, domain: str, download_dir: str, attrs_to_search: list,
+                      verbose: bool = False, rewrite: bool = True) -> tuple:
+    """
+    Scans a single HTML file for URLs as described in check_attrs.
+
+    Args:
+        file_path (str): Path of the HTML file to scan
         domain (str): The website domain (e.g., 'https://example.com')
         download_dir (str): Directory containing the downloaded website files
-        attrs (str): Comma-separated list of HTML attributes to check for URLs
+        attrs_to_search (list): HTML attributes to check for URLs
+        verbose (bool): Report every attribute checked and every URL found
+        rewrite (bool): Make the URLs of the current domain site-relative in the file
 
     Returns:
-        set: Set of additional URLs found in the specified attributes
+        tuple: (set of additional URLs found in the file, list of messages to print). The file
+            may be scanned in a worker process, so the messages are printed by the caller
     """
     # Parse domain for comparison
     parsed_domain = urllib.parse.urlparse(domain)
     domain_base = f"{parsed_domain.scheme}://{parsed_domain.netloc}"
-    
-    attrs_to_search = attrs.split(",") if attrs else []
+
+    attr_names = frozenset(attrs_to_search)
     extra_urls = set()
+    messages = []
+
+    # (attribute, old value, new value) edits to apply to the raw markup
+    rewrites = []
     
-    print(f"Checking attributes {attrs_to_search} in {download_dir}...")
+    # Calculate the relative path from download_dir to the current file
+    rel_path = os.path.relpath(file_path, download_dir)
+    # Convert Windows path separators to URL path separators if needed
+    rel_path = rel_path.replace(os.path.sep, '/')
+    # Remove the filename to get the directory
+    rel_dir = os.path.dirname(rel_path)
     
-    # Regular expression to find URLs in JavaScript code like location.href='url'
-    location_href_pattern = re.compile(r"location\.href\s*=\s*['\"]([^'\"]+)['\"]")
+    # Construct the base URL for this file (for resolving relative URLs)
+    if rel_dir:
+        file_base_url = f"{domain}/{rel_dir}/"
+    else:
+        file_base_url = f"{domain}/"
     
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith((".html", ".php", ".asp")):
-                file_path = os.path.join(root, file)
-                modified = False
-                
-                # Calculate the relative path from download_dir to the current file
-                rel_path = os.path.relpath(file_path, download_dir)
-                # Convert Windows path separators to URL path separators if needed
-                rel_path = rel_path.replace(os.path.sep, '/')
-                # Remove the filename to get the directory
-                rel_dir = os.path.dirname(rel_path)
+    with open(file_path, "rb") as f:
+        raw = f.read()
+    root = etree.fromstring(raw, HTML_PARSER) if attr_names else None
+    # Empty documents have no root
+    if root is None:
+        return extra_urls, messages
+    for element in _ATTRS_XPATH(root, names=f" {' '.join(attr_names)} "):
+        for attr, value in element.items():
+            if attr in attr_names:
+                if verbose:
+                    messages.append(f"Checking attribute {attr} in {file_path}, value: {value}...")
                 
-                # Construct the base URL for this file (for resolving relative URLs)
-                if rel_dir:
-                    file_base_url = f"{domain}/{rel_dir}/"
-                else:
-                    file_base_url = f"{domain}/"
+                # Check for direct URLs in attribute values
+                if is_probably_url(value):
+                    # Add to extra URLs for downloading
+                    absolute_url = urllib.parse.urljoin(domain, value)
+                    extra_urls.add(absolute_url)
+                    
+                    # Transform absolute URLs with current domain to site-relative
+                    if value.startswith(domain_base):
+                        # Extract the path part and make it site-relative
+                        parsed_url = urllib.parse.urlparse(value)
+                        site_relative_url = parsed_url.path
+                        if parsed_url.query:
+                            site_relative_url += "?" + parsed_url.query
+                        if parsed_url.fragment:
+                            site_relative_url += "#" + parsed_url.fragment
+                            
+                        # Update the attribute value
+                        rewrites.append((attr, value, site_relative_url))
                 
-                with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                    soup = BeautifulSoup(f, "html.parser")
-                    for tag in soup.find_all():
-                        for attr, value in tag.attrs.items():
-                            if attr in attrs_to_search and isinstance(value, str):
-                                print(f"Checking attribute {attr} in {file_path}, value: {value}...")
-                                
-                                # Check for direct URLs in attribute values
-                                if is_probably_url(value):
-                                    # Add to extra URLs for downloading
-                                    absolute_url = urllib.parse.urljoin(domain, value)
-                                    extra_urls.add(absolute_url)
-                                    
-                                    # Transform absolute URLs with current domain to site-relative
-                                    if value.startswith(domain_base):
-                                        # Extract the path part and make it site-relative
-                                        parsed_url = urllib.parse.urlparse(value)
-                                        site_relative_url = parsed_url.path
-                                        if parsed_url.query:
-                                            site_relative_url += "?" + parsed_url.query
-                                        if parsed_url.fragment:
-                                            site_relative_url += "#" + parsed_url.fragment
-                                            
-                                        # Update the attribute value
-                                        tag[attr] = site_relative_url
-                                        modified = True
+                # Check for URLs hidden in JavaScript code (like onclick="location.href='url'")
+                href_matches = _LOCATION_HREF_RE.findall(value)
+                for href in href_matches:
+                    if verbose:
+                        messages.append(f"Found location.href URL in {attr}: {href}")
+                    if is_probably_url(href):
+                        # Use the file's base URL to resolve relative URLs properly
+                        absolute_url = urllib.parse.urljoin(file_base_url, href)
+                        extra_urls.add(absolute_url)
+                        if verbose:
+                            messages.append(f"  Resolved to: {absolute_url}")
+                        
+                        # If the URL is on the same domain, convert it to site-relative
+                        if absolute_url.startswith(domain_base):
+                            # Extract the path part and make it site-relative
+                            parsed_url = urllib.parse.urlparse(absolute_url)
+                            site_relative_url = parsed_url.path
+                            if parsed_url.query:
+                                site_relative_url += "?" + parsed_url.query
+                            if parsed_url.fragment:
+                                site_relative_url += "#" + parsed_url.fragment
                                 
-                                # Check for URLs hidden in JavaScript code (like onclick="location.href='url'")
-                                href_matches = location_href_pattern.findall(value)
-                                for href in href_matches:
-                                    print(f"Found location.href URL in {attr}: {href}")
-                                    if is_probably_url(href):
-                                        # Use the file's base URL to resolve relative URLs properly
-                                        absolute_url = urllib.parse.urljoin(file_base_url, href)
-                                        extra_urls.add(absolute_url)
-                                        print(f"  Resolved to: {absolute_url}")
-                                        
-                                        # If the URL is on the same domain, convert it to site-relative
-                                        if absolute_url.startswith(domain_base):
-                                            # Extract the path part and make it site-relative
-                                            parsed_url = urllib.parse.urlparse(absolute_url)
-                                            site_relative_url = parsed_url.path
-                                            if parsed_url.query:
-                                                site_relative_url += "?" + parsed_url.query
-                                            if parsed_url.fragment:
-                                                site_relative_url += "#" + parsed_url.fragment
-                                                
-                                            # Replace the URL in the JavaScript code with the site-relative URL
-                                            new_value = value.replace(f"location.href='{href}'", f"location.href='{site_relative_url}'")
-                                            new_value = new_value.replace(f'location.href="{href}"', f'location.href="{site_relative_url}"')
-                                            
-                                            if new_value != value:
-                                                tag[attr] = new_value
-                                                modified = True
-                                                print(f"  Updated to use site-relative URL: {site_relative_url}")
-                
-                # Save the file only if modifications were made
-                if modified:
-                    with open(file_path, "w", encoding="utf-8") as f:
-                        f.write(str(soup))
+                            # Replace the URL in the JavaScript code with the site-relative URL
+                            new_value = value.replace(f"location.href='{href}'", f"location.href='{site_relative_url}'")
+                            new_value = new_value.replace(f'location.href="{href}"', f'location.href="{site_relative_url}"')
+                            
+                            if new_value != value:
+                                rewrites.append((attr, value, new_value))
+                                if verbose:
+                                    messages.append(f"  Updated to use site-relative URL: {site_relative_url}")
+
+    # The edits are applied to the original markup instead of re-serializing
+    # the tree, which would reformat the whole page
+    if rewrite and rewrites:
+        content = raw.decode("utf-8", errors="ignore")
+        for attr, old_value, new_value in rewrites:
+            content = replace_attr_value(content, attr, old_value, new_value)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+    return extra_urls, messages
+
+def check_attrs(domain: str, download_dir: str, attrs: str, files=None, verbose: bool = False,
+                rewrite: bool = True, quiet: bool = False) -> set:
+    """
+    Checks for URLs in specified attributes of HTML files and adds them to the list of extra URLs.
+    Also transforms absolute URLs that include the current domain into site-relative URLs.
+    Also extracts URLs hidden in JavaScript code within attributes like onclick="location.href='url'".
+
+    Args:
+        domain (str): The website domain (e.g., 'https://example.com')
+        download_dir (str): Directory containing the downloaded website files
+        attrs (str): Comma-separated list of HTML attributes to check for URLs
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
+        verbose (bool): Print every attribute checked and every URL found, instead of a progress count
+        rewrite (bool): Make the URLs of the current domain site-relative; when False the files
+            are only read, e.g. while wget may still be writing them
+        quiet (bool): Print nothing unless verbose, e.g. for scans repeated while wget is running
+
+    Returns:
+        set: Set of additional URLs found in the specified attributes
+    """
+    attrs_to_search = [attr.strip() for attr in attrs.split(",") if attr.strip()] if attrs else []
+    extra_urls = set()
     
+    if not quiet:
+        print(f"Checking attributes {attrs_to_search} in {download_dir}...")
+    
+    files = _select_files(download_dir, files, (".html", ".php", ".asp"))
+    check_file = partial(_check_attrs_file, domain=domain, download_dir=download_dir,
+                         attrs_to_search=attrs_to_search, verbose=verbose, rewrite=rewrite)
+    for count, (file_urls, messages) in enumerate(map_files(check_file, files), 1):
+        for message in messages:
+            print(message)
+        extra_urls |= file_urls
+        if not (verbose or quiet) and count % 100 == 0:
+            print(f"Checked {count} files...")
+
     return extra_urls
 
-def normalize_html(domain: str, download_dir: str):
+def mask_server_code(content: bytes):
+    """
+    Replaces the server-side code of a page with placeholders, see _SERVER_CODE_RE.
+
+    Args:
+        content (bytes): The raw page
+
+    Returns:
+        tuple: (masked content, dict of the code regions, keyed by placeholder digest)
+    """
+    regions = {}
+    parts = []
+    in_tag = False
+    pos = 0
+    for match in _SERVER_CODE_RE.finditer(content):
+        # The markup since the previous region tells whether this one is inside a tag
+        segment = content[pos:match.start()]
+        last_open, last_close = segment.rfind(b'<'), segment.rfind(b'>')
+        if last_open > last_close:
+            in_tag = segment[last_open + 1:last_open + 2].isalpha()
+        elif last_close > last_open:
+            in_tag = False
+        key = hashlib.md5(match.group(0)).hexdigest()[:12].encode()
+        placeholder = b'%s%sx' % (_SERVER_CODE_PLACEHOLDER.encode(), key)
+        parts += [segment, placeholder if in_tag else b'<!--' + placeholder + b'-->']
+        regions[key] = match.group(0)
+        pos = match.end()
+    if not regions:
+        return content, regions
+    parts.append(content[pos:])
+    return b''.join(parts), regions
+
+def unmask_server_code(content: bytes, regions: dict) -> bytes:
+    """
+    Puts back the server-side code replaced by mask_server_code.
+
+    Args:
+        content (bytes): The serialized page
+        regions (dict): The code regions returned by mask_server_code
+
+    Returns:
+        bytes: The page with its original server-side code
+    """
+    if not regions:
+        return content
+    return _SERVER_CODE_PLACEHOLDER_RE.sub(lambda m: regions.get(m.group(1), m.group(0)), content)
+
+def _is_partial(content: bytes) -> bool:
+    """
+    Tells whether a page closes tags it does not open, or leaves open tags that need an end tag.
+
+    Args:
+        content (bytes): The page, with its server-side code masked
+
+    Returns:
+        bool: True if the page is part of a page, see _OPTIONAL_END_TAGS
+    """
+    content = _RAW_TEXT_RE.sub(rb'\1\3', _COMMENT_RE.sub(b'', content))
+    depth = {}
+    for match in _TAG_RE.finditer(content):
+        closing, name, self_closing = match.groups()
+        name = name.lower()
+        if name in _VOID_TAGS or self_closing:
+            continue
+        if closing:
+            depth[name] = depth.get(name, 0) - 1
+            if depth[name] < 0:
+                return True
+        else:
+            depth[name] = depth.get(name, 0) + 1
+    return any(count and name not in _OPTIONAL_END_TAGS for name, count in depth.items())
+
+def _serialize_page(root, fragment: bool, pretty: bool) -> bytes:
+    """
+    Serializes a page parsed by process_file.
+
+    Args:
+        root (etree._Element): Root element of the parsed page
+        fragment (bool): The page was parsed inside an added <html><body>, of which only
+            the content is serialized
+        pretty (bool): Indent the elements; text with content is left as is
+
+    Returns:
+        bytes: The serialized page
+    """
+    body = root.find('body') if fragment else None
+    if body is None:
+        if pretty:
+            etree.indent(root, space=' ')
+            # The tree is serialized with its doctype, and void elements without closing tags
+            return etree.tostring(root.getroottree(), method='html', encoding='utf-8') + b'\n'
+        return etree.tostring(root.getroottree(), method='html', encoding='utf-8')
+
+    text = body.text or ''
+    if pretty:
+        if not text.strip():
+            text = ''
+        # Each top-level element is indented on its own, from the first column
+        # (comments, like the placeholders of server-side code, cannot be indented)
+        for child in body:
+            if isinstance(child.tag, str):
+                etree.indent(child, space=' ')
+            if not (child.tail and child.tail.strip()):
+                child.tail = '\n'
+    # The leading text is escaped the way lxml escapes text
+    return html.escape(text, quote=False).encode('utf-8') + b''.join(
+        etree.tostring(child, method='html', encoding='utf-8') for child in body)
+
+def _normalize_tree(root, relative_dir: str, domain_base: str, edits=None) -> bool:
+    """
+    Rewrites the URLs of a parsed page as described in normalize_html.
+
+    Args:
+        root (etree._Element): Root element of the parsed page, modified in place
+        relative_dir (str): Directory of the page relative to the site root ('' for the root)
+        domain_base (str): Scheme and host of the website (e.g., 'https://example.com')
+        edits (dict, optional): Filled with (attribute, old value) -> new value for each
+            rewritten URL, so they can be applied to the raw markup with replace_attr_value
+
+    Returns:
+        bool: True if the page was modified
+    """
+    modified = False
+
+    # Elements only, comments and processing instructions have no attributes
+    for tag in root.iter(etree.Element):
+        # Only process href and src attributes
+        for attr_name in ['href', 'src', 'data-lazyload', 'data-src', 'data-image-src']:
+            value = tag.get(attr_name)
+            if value is None:
+                continue
+
+            new_value = value
+            first = value[:1]
+
+            # Skip URLs that are:
+            # - Already absolute paths
+            # - Absolute URLs (http://, https://, //)
+            # - Anchors only (#)
+            # - JavaScript or data URIs
+            # - Generated by server-side code
+            if value.startswith(_SERVER_CODE_PLACEHOLDER):
+                continue
+            if first in _URL_SKIP_FIRST_CHARS or value.startswith(_URL_SKIP_PREFIXES):
+                # Convert domain-based absolute URLs to path-based
+                if value.startswith(domain_base):
+                    new_value = value[len(domain_base):]
+                    if not new_value.startswith('/'):
+                        new_value = '/' + new_value
+                    modified = True
+
+            elif value.strip():
+                # Handle ../ paths
+                if first == '.' and value.startswith('../'):
+                    path_parts = relative_dir.split(os.sep)
+                    up_count = value.count('../')
+                    if len(path_parts) >= up_count:
+                        new_path = '/'.join(path_parts[:-up_count])
+                        if new_path:
+                            new_value = '/' + new_path + '/' + value[3 * up_count:]
+                        else:
+                            new_value = '/' + value[3 * up_count:]
+                # Handle ./ paths
+                elif first == '.' and value.startswith('./'):
+                    if relative_dir:
+                        new_value = '/' + relative_dir + '/' + value[2:]
+                    else:
+                        new_value = '/' + value[2:]
+                # Handle relative paths without ./ or ../
+                else:
+                    if relative_dir:
+                        new_value = '/' + relative_dir + '/' + value
+                    else:
+                        new_value = '/' + value
+
+                modified = True
+
+            # Update .asp.html and .php.html extensions
+            # (most values have neither, so the substring tests spare them the regexes)
+            if '.html' in new_value.lower():
+                updated_value = _ASP_PHP_HTML_RE.sub(r'.html\2', new_value)
+                if updated_value != new_value:
+                    new_value = updated_value
+                    modified = True
+
+            # Clean up double slashes in paths (but keep // in protocol)
+            if '//' in new_value:
+                if '://' in new_value:
+                    protocol, path = new_value.split('://', 1)
+                    if '//' in path:
+                        path = _DOUBLE_SLASH_RE.sub('/', path)
+                        new_value = f"{protocol}://{path}"
+                else:
+                    new_value = _DOUBLE_SLASH_RE.sub('/', new_value)
+
+            if new_value != value:
+                tag.set(attr_name, new_value)
+                if edits is not None:
+                    edits[attr_name, value] = new_value
+
+    return modified
+
+def _php_refs_re(html_files: set):
+    """
+    Builds the regex that finds the references to the pages in html_files, as described in
+    php_rename. A reference is a file name that starts a string or follows a slash, quote,
+    equal sign or whitespace, and ends before a quote, '>', whitespace, query or fragment.
+
+    Args:
+        html_files (set): File names of the pages that will be renamed to .php
+
+    Returns:
+        re.Pattern: A bytes regex capturing the referenced file name
+    """
+    # Longer names come first so they win over names that are their suffix
+    names = sorted((re.escape(name.encode('utf-8')) for name in html_files), key=len, reverse=True)
+    return re.compile(rb'(?<![^/"\'=\s])(' + b'|'.join(names) + rb')(?=[\s"\'>?#])')
+
+def _php_ref(match) -> bytes:
+    # page.html -> page.php (and page.htm -> page.php)
+    return match.group(1).rsplit(b'.', 1)[0] + b'.php'
+
+def _file_stamp(path: str) -> list:
+    """
+    Returns the size and modification time of a file, which change whenever it is rewritten.
+
+    Args:
+        path (str): Path of the file
+
+    Returns:
+        list: [size, mtime in nanoseconds], a list so it compares equal to its JSON form
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def _pretty_cache_path(domain: str, cache_dir: str) -> str:
+    """
+    Returns the file holding the stamps of the pages pretty printed by a previous run. It sits
+    in cache_dir (e.g. mirrors/.pretty_cache), outside the site, so it is neither deployed with
+    the site nor picked up by the walks of the site, even when the domain has a path.
+
+    Args:
+        domain (str): The original website domain (e.g., 'https://example.com/blog')
+        cache_dir (str): Directory of the cache files
+
+    Returns:
+        str: Path of the cache file of the domain
+    """
+    parsed_domain = urllib.parse.urlparse(domain)
+    name = _CACHE_NAME_RE.sub('_', (parsed_domain.netloc + parsed_domain.path).strip('/'))
+    return os.path.join(cache_dir, name + '.json')
+
+def _load_pretty_cache(cache_path: str) -> dict:
+    """
+    Loads the stamps of the pages pretty printed by a previous run.
+
+    Args:
+        cache_path (str): Path of the cache file (see _pretty_cache_path)
+
+    Returns:
+        dict: Page path relative to download_dir -> stamp (see _file_stamp), empty if there is no cache
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_pretty_cache(cache_path: str, pretty_cache: dict):
+    """
+    Saves the stamps of the pretty printed pages for the next run.
+
+    Args:
+        cache_path (str): Path of the cache file (see _pretty_cache_path)
+        pretty_cache (dict): Page path relative to download_dir -> stamp (see _file_stamp)
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(pretty_cache, f)
+    except OSError as e:
+        print(f"Error saving the pretty print cache: {e}")
+
+def process_file(path: str, ops: set, ctx: dict) -> tuple:
+    """
+    Applies the selected transformations to a single page: the file is read and parsed once,
+    every transformation runs on the same tree, and the result is written once.
+    fix-query and php-rename rewrite the raw and serialized bytes, so on their own they do
+    not need a parse. CSS files only go through fix-query; when it is the only transformation
+    that applies, the file is streamed instead (see _fix_query_file). Partial pages (see _is_partial) are
+    never re-serialized: their URLs are rewritten in the raw markup and they are not pretty printed.
+
+    Args:
+        path (str): Path of the page
+        ops (set): Transformations to apply ("fix-query", "normalize-html", "php-rename", "pretty-print")
+        ctx (dict): Data shared by all files, as prepared by apply_transforms
+            ('download_dir', 'domain_base', 'query_refs_re', 'query_refs', 'query_refs_len'
+            and 'php_refs_re')
+
+    Returns:
+        tuple: (True if the file was processed, False if it could not be processed, list of
+            messages to print). The file may be processed in a worker process, so the messages
+            are printed by the caller
+    """
+    try:
+        is_page = path.endswith(_PAGE_EXTS)
+        if not (is_page and ops - {"fix-query"}):
+            # Only fix-query applies, so the file does not need to be held in memory
+            if "fix-query" in ops and path.endswith(('.html', '.css')):
+                _fix_query_file(path, ctx)
+            return True, []
+
+        with open(path, 'rb') as f:
+            raw = f.read()
+        content = raw
+
+        if "fix-query" in ops and path.endswith(('.html', '.css')):
+            # Replace each old reference with the new one
+            query_refs = ctx['query_refs']
+            content = ctx['query_refs_re'].sub(lambda m: query_refs[m.group(0)], content)
+
+        root = None
+        partial = False
+        if is_page and ("normalize-html" in ops or "pretty-print" in ops):
+            # PHP and ASP code is kept out of the parser's reach
+            masked, server_code = mask_server_code(content)
+            partial = _is_partial(masked)
+            fragment = _DOCUMENT_TAG_RE.search(masked) is None
+            if "normalize-html" in ops or not partial:
+                root = etree.fromstring(b'<html><body>' + masked + b'</body></html>' if fragment else masked,
+                                        HTML_PARSER)
+        # Empty documents have no root
+        if root is not None:
+            modified = False
+            # URLs rewritten in a partial page, which is edited in place and not pretty printed
+            edits = {} if partial else None
+
+            if "normalize-html" in ops:
+                # Calculate the relative path from domain root for the current file
+                relative_dir = os.path.relpath(os.path.dirname(path), ctx['download_dir'])
+                if relative_dir == '.':
+                    relative_dir = ''
+                modified = _normalize_tree(root, relative_dir, ctx['domain_base'], edits)
+
+            if partial:
+                if modified:
+                    text = masked.decode('utf-8', 'surrogateescape')
+                    for (attr_name, value), new_value in edits.items():
+                        text = replace_attr_value(text, attr_name, value, new_value)
+                    content = unmask_server_code(text.encode('utf-8', 'surrogateescape'), server_code)
+            elif "pretty-print" in ops or modified:
+                content = unmask_server_code(_serialize_page(root, fragment, "pretty-print" in ops), server_code)
+
+        if "php-rename" in ops and path.endswith(('.html', '.php')):
+            # Replace .html with .php in the references
+            content = ctx['php_refs_re'].sub(_php_ref, content)
+
+        if content != raw or ("pretty-print" in ops and is_page):
+            with open(path, 'wb') as f:
+                f.write(content)
+        return True, []
+
+    except Exception as e:
+        return False, [f"Error processing {path}: {e}"]
+
+def apply_transforms(domain: str, download_dir: str, ops: set, files=None, cache_dir=None):
+    """
+    Runs fix-query, normalize-html, php-rename and pretty-print over a downloaded website in
+    a single pass: the renames they need are planned and executed up front, then every page is
+    parsed and written only once (see process_file) whatever the number of selected
+    transformations. The effect is the same as running fix_query_strings, normalize_html,
+    php_rename and pretty_print one after the other.
+
+    Args:
+        domain (str): The original website domain (e.g., 'https://example.com')
+        download_dir (str): Directory containing the downloaded website files
+        ops (set): Transformations to apply ("fix-query", "normalize-html", "php-rename", "pretty-print")
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
+        cache_dir (str, optional): Directory where the stamps of the pretty printed pages are
+            kept, so unchanged pages are skipped by later runs; without it every page is pretty printed
+    """
+    ops = set(ops)
+    parsed_domain = urllib.parse.urlparse(domain)
+    ctx = {
+        'download_dir': download_dir,
+        'domain_base': f"{parsed_domain.scheme}://{parsed_domain.netloc}",
+        'query_refs_re': None,
+        'query_refs': {},
+        'query_refs_len': 0,
+        'php_refs_re': None,
+    }
+
+    # CSS files whose references fix-query updates
+    css_files = []
+    if "fix-query" in ops:
+        # Rename the files with a query string; files becomes the listing after the renames
+        ctx['query_refs_re'], ctx['query_refs'], files = _rename_query_files(download_dir, files)
+        if ctx['query_refs_re'] is None:
+            ops.discard("fix-query")
+        else:
+            ctx['query_refs_len'] = max(map(len, ctx['query_refs']))
+            css_files = _select_files(download_dir, files, '.css')
+
+    # Collect the pages in a single walk
+    pages = list(_select_files(download_dir, files, _PAGE_EXTS))
+
+    if "normalize-html" in ops:
+        # Rename the .asp.html and .php.html files
+        rename_map = {}
+        for page in pages:
+            root, file = os.path.split(page)
+            if file.endswith(('.asp.html', '.php.html')):
+                rename_map[page] = os.path.join(root, _ASP_PHP_HTML_NAME_RE.sub('.html', file))
+        for old_path, new_path in rename_map.items():
+            os.rename(old_path, new_path)
+        pages = [rename_map.get(page, page) for page in pages]
+        # References are only rewritten when a page was renamed
+        if not rename_map:
+            ops.discard("normalize-html")
+
+    if "php-rename" in ops:
+        # Collect all HTML files that will be renamed
+        html_files = {os.path.basename(page) for page in pages if page.endswith(('.htm', '.html'))}
+        if html_files:
+            ctx['php_refs_re'] = _php_refs_re(html_files)
+        else:
+            ops.discard("php-rename")
+
+    cache_path = _pretty_cache_path(domain, cache_dir) if cache_dir and "pretty-print" in ops else None
+    pretty_cache = _load_pretty_cache(cache_path) if cache_path else {}
+    to_process = pages
+    if ops == {"pretty-print"} and pretty_cache:
+        # Pages that have not changed since they were last pretty printed are skipped
+        to_process = [page for page in pages
+                      if pretty_cache.get(os.path.relpath(page, download_dir)) != _file_stamp(page)]
+
+    # Pages successfully processed
+    done = []
+    if ops:
+        if "pretty-print" in ops:
+            print(f"Applying pretty print to files in {download_dir}...")
+
+        # Keep track of processed files
+        processed_files = 0
+        targets = to_process + css_files
+        for page, (processed, messages) in zip(targets, map_files(partial(process_file, ops=ops, ctx=ctx), targets)):
+            for message in messages:
+                print(message)
+            if processed and page.endswith(_PAGE_EXTS):
+                done.append(page)
+                processed_files += 1
+                if "pretty-print" in ops and processed_files % 50 == 0:
+                    print(f"Processed {processed_files} files...")
+
+        if "pretty-print" in ops:
+            skipped = len(pages) - len(to_process)
+            print(f"Pretty print completed. Processed {processed_files} files"
+                  + (f", skipped {skipped} unchanged files." if skipped else "."))
+
+    # Final path of each page
+    final_paths = {}
+    if "php-rename" in ops:
+        # Final pass: rename all HTML files to PHP
+        for old_path in pages:
+            root, file = os.path.split(old_path)
+            if file.endswith(('.htm', '.html')):
+                # Use os.path.splitext to safely handle extensions of any length
+                filename, extension = os.path.splitext(file)
+                new_path = os.path.join(root, filename + '.php')
+                os.rename(old_path, new_path)
+                final_paths[old_path] = new_path
+
+    if cache_path:
+        # Renames keep the size and modification time, so the stamps are taken on the final paths
+        pages = [final_paths.get(page, page) for page in pages]
+        keys = {page: os.path.relpath(page, download_dir) for page in pages}
+        # Entries of pages that no longer exist are dropped
+        pretty_cache = {keys[page]: pretty_cache[keys[page]] for page in pages if keys[page] in pretty_cache}
+        for page in done:
+            page = final_paths.get(page, page)
+            pretty_cache[keys[page]] = _file_stamp(page)
+        _save_pretty_cache(cache_path, pretty_cache)
+
+def normalize_html(domain: str, download_dir: str, files=None):
     """
     Normalizes HTML files in a downloaded website directory by:
     1. Renaming .asp.html and .php.html files to .html
@@ -192,144 +1002,12 @@ def normalize_html(domain: str, download_dir: str):
     Args:
         domain (str): The original website domain (e.g., 'https://example.com')
         download_dir (str): Directory containing the downloaded website files
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
     """
-    # Get the domain for absolute URL conversion
-    parsed_domain = urllib.parse.urlparse(domain)
-    domain_base = f"{parsed_domain.scheme}://{parsed_domain.netloc}"
+    apply_transforms(domain, download_dir, {"normalize-html"}, files)
 
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith(('.asp.html', '.php.html')):
-                old_path = os.path.join(root, file)
-                new_name = re.sub(
-                    r'\.(asp|php)\.html$', '.html', file, flags=re.IGNORECASE)
-                new_path = os.path.join(root, new_name)
-                os.rename(old_path, new_path)
 
-                # Update references in all HTML files
-                for html_root, _, html_files in os.walk(download_dir):
-                    for html_file in html_files:
-                        if html_file.endswith(('.html', '.htm', '.asp', '.php', '.asp.html', '.php.html')):
-                            html_path = os.path.join(
-                                html_root, html_file)
-                            try:
-                                with open(html_path, 'r', encoding='utf-8', errors='ignore') as f:
-                                    content = f.read()
-
-                                soup = BeautifulSoup(
-                                    content, 'html.parser')
-                                modified = False
-
-                                # Calculate the relative path from domain root for the current file
-                                relative_dir = os.path.relpath(
-                                    html_root, download_dir)
-                                if relative_dir == '.':
-                                    relative_dir = ''
-
-                                for tag in soup.find_all(True):
-                                    # Only process href and src attributes
-                                    for attr_name in ['href', 'src', 'data-lazyload', 'data-src', 'data-image-src']:
-                                        if not tag.has_attr(attr_name):
-                                            continue
-
-                                        value = tag[attr_name]
-                                        if not isinstance(value, str):
-                                            continue
-
-                                        new_value = value
-
-                                        # Skip URLs that are:
-                                        # - Already absolute paths
-                                        # - Absolute URLs (http://, https://, //)
-                                        # - Anchors only (#)
-                                        # - JavaScript or data URIs
-                                        if (not value.startswith(('/', 'http://', 'https://', '//', '#', 'javascript:', 'data:', 'mailto:', 'tel:')) and
-                                                value.strip() and not value.startswith('{')):
-
-                                            # Handle ../ paths
-                                            if value.startswith('../'):
-                                                path_parts = relative_dir.split(
-                                                    os.sep)
-                                                up_count = value.count(
-                                                    '../')
-                                                if len(path_parts) >= up_count:
-                                                    new_path = '/'.join(
-                                                        path_parts[:-up_count])
-                                                    if new_path:
-                                                        new_value = '/' + new_path + \
-                                                            '/' + \
-                                                            value[3 *
-                                                                    up_count:]
-                                                    else:
-                                                        new_value = '/' + \
-                                                            value[3 *
-                                                                    up_count:]
-                                            # Handle ./ paths
-                                            elif value.startswith('./'):
-                                                if relative_dir:
-                                                    new_value = '/' + \
-                                                        relative_dir + \
-                                                        '/' + \
-                                                        value[2:]
-                                                else:
-                                                    new_value = '/' + \
-                                                        value[2:]
-                                            # Handle relative paths without ./ or ../
-                                            else:
-                                                if relative_dir:
-                                                    new_value = '/' + relative_dir + '/' + value
-                                                else:
-                                                    new_value = '/' + value
-
-                                            modified = True
-
-                                        # Convert domain-based absolute URLs to path-based
-                                        elif value.startswith(domain_base):
-                                            new_value = value[len(
-                                                domain_base):]
-                                            if not new_value.startswith('/'):
-                                                new_value = '/' + new_value
-                                            modified = True
-
-                                        # Update .asp.html and .php.html extensions
-                                        updated_value = re.sub(
-                                            r'\.(asp|php)\.html($|\?|#)', r'.html\2', new_value, flags=re.IGNORECASE)
-                                        if updated_value != new_value:
-                                            new_value = updated_value
-                                            modified = True
-
-                                        # Clean up double slashes in paths (but keep // in protocol)
-                                        if '://' in new_value:
-                                            protocol, path = new_value.split(
-                                                '://', 1)
-                                            path = re.sub(
-                                                r'//+', '/', path)
-                                            new_value = f"{protocol}://{path}"
-                                        else:
-                                            new_value = re.sub(
-                                                r'//+', '/', new_value)
-
-                                        if new_value != value:
-                                            tag[attr_name] = new_value
-
-                                if modified:
-                                    html_content = str(soup)
-                                    # List of void elements that should be self-closing
-                                    void_elements = ['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 
-                                                    'link', 'meta', 'param', 'source', 'track', 'wbr']
-                                    
-                                    # Remove incorrect closing tags
-                                    for tag in void_elements:
-                                        html_content = re.sub(f'</{tag}>', '', html_content)
-                                    
-                                    with open(html_path, 'w', encoding='utf-8') as f:
-                                        f.write(html_content)
-                            except Exception as e:
-                                print(
-                                    f"Error processing {html_path}: {str(e)}")
-                                
-                                
-def php_rename(domain: str, download_dir: str):
+def php_rename(domain: str, download_dir: str, files=None):
     """
     Renames all .html files to .php and updates all references to these files across the site.
     This includes updating links and other attributes that reference .html files to point to
@@ -338,128 +1016,20 @@ def php_rename(domain: str, download_dir: str):
     Args:
         domain (str): The website domain (not used in current implementation)
         download_dir (str): Directory containing the downloaded website files
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
     """
-    # First pass: collect all HTML files that will be renamed
-    html_files = set()
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith(('.htm', '.html')):
-                html_files.add(file)
-
-    # Second pass: update references in all HTML and PHP files
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith(('.asp.html', '.html', '.php')):
-                file_path = os.path.join(root, file)
-                modified = False
-                
-                try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        soup = BeautifulSoup(f, 'html.parser')
-                        
-                    # Update href attributes in links
-                    for tag in soup.find_all(['a', 'link', 'area', 'base']):
-                        if tag.has_attr('href'):
-                            href = tag['href']
-                            if isinstance(href, str):
-                                # Extract the filename from the href
-                                parsed = urllib.parse.urlparse(href)
-                                path = parsed.path
-                                filename = os.path.basename(path)
-                                
-                                if filename in html_files:
-                                    # Replace .html with .php in the href
-                                    new_filename = filename[:-5] + '.php'
-                                    new_href = href.replace(filename, new_filename)
-                                    tag['href'] = new_href
-                                    modified = True
-                    
-                    # Update other attributes that might contain file references
-                    for tag in soup.find_all():
-                        for attr in ['src', 'data-src', 'data-href']:
-                            if tag.has_attr(attr):
-                                value = tag[attr]
-                                if isinstance(value, str):
-                                    parsed = urllib.parse.urlparse(value)
-                                    path = parsed.path
-                                    filename = os.path.basename(path)
-                                    
-                                    if filename in html_files:
-                                        new_filename = filename[:-5] + '.php'
-                                        new_value = value.replace(filename, new_filename)
-                                        tag[attr] = new_value
-                                        modified = True
-                    
-                    # Save changes if any modifications were made
-                    if modified:
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            f.write(str(soup))
-                
-                except Exception as e:
-                    print(f"Error processing {file_path}: {str(e)}")
+    apply_transforms(domain, download_dir, {"php-rename"}, files)
 
-    # Final pass: rename all HTML files to PHP
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith(('.htm', '.html')):
-                old_path = os.path.join(root, file)
-                # Use os.path.splitext to safely handle extensions of any length
-                filename, extension = os.path.splitext(file)
-                new_path = os.path.join(root, filename + '.php')
-                os.rename(old_path, new_path)
 
-
-def pretty_print(domain: str, download_dir: str):
+def pretty_print(domain: str, download_dir: str, files=None, cache_dir=None):
     """
     Applies pretty printing to HTML, PHP, and ASP files in the downloaded directory.
     This reformats the HTML content to be more readable with proper indentation.
     
     Args:
-        domain (str): The website domain (not used in current implementation)
+        domain (str): The website domain, which names the cache file in cache_dir
         download_dir (str): Directory containing the downloaded website files
+        files (list, optional): Paths of all the files below download_dir, to avoid walking it again
+        cache_dir (str, optional): Directory where the stamps of the pretty printed pages are kept
     """
-    print(f"Applying pretty print to files in {download_dir}...")
-    
-    # Keep track of processed files
-    processed_files = 0
-    
-    # Process all HTML, PHP, and ASP files
-    for root, dirs, files in os.walk(download_dir):
-        for file in files:
-            if file.endswith(('.htm', '.html', '.php', '.asp', '.asp.html', '.php.html')):
-                file_path = os.path.join(root, file)
-                try:
-                    # Read the file content
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read()
-                    
-                    # Parse with BeautifulSoup using lxml parser if available, otherwise html.parser
-                    try:
-                        soup = BeautifulSoup(content, 'lxml')
-                    except:
-                        soup = BeautifulSoup(content, 'html.parser')
-                    
-                    # Pretty print the content
-                    pretty_content = soup.prettify()
-                    
-                    # Fix self-closing tags that BeautifulSoup might have incorrectly formatted
-                    # List of void elements that should be self-closing
-                    void_elements = ['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 
-                                    'link', 'meta', 'param', 'source', 'track', 'wbr']
-                    
-                    # Remove incorrect closing tags
-                    for tag in void_elements:
-                        pretty_content = re.sub(f'</{tag}>', '', pretty_content)
-                    
-                    # Write back the formatted content
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(pretty_content)
-                    
-                    processed_files += 1
-                    if processed_files % 50 == 0:
-                        print(f"Processed {processed_files} files...")
-                        
-                except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
-    
-    print(f"Pretty print completed. Processed {processed_files} files.")
\ No newline at end of file
+    apply_transforms(domain, download_dir, {"pretty-print"}, files, cache_dir)
@@ -1,191 +1,530 @@
 #!/usr/bin/env python3
 import os
 import subprocess
-import urllib.parse
+import sys
 import configparser
+import json
 import re
-from helpers import normalize_html, check_attrs, php_rename, fix_query_strings, pretty_print
-from php_refactor import extract_php_includes
-from prompt_toolkit.shortcuts import input_dialog
-from prompt_toolkit.shortcuts import checkboxlist_dialog
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from helpers import apply_transforms, check_attrs, pretty_print, iter_files
+
+# URLs of page files (HTML, ASP, PHP, etc.), optionally followed by a query string
+_PAGE_RE = re.compile(r'\.(html|htm|asp|php|jsp|aspx|do|cgi)(\?|$)', re.IGNORECASE)
+
+# Operations offered to the user, in execution order
+_OPERATION_CHOICES = (
+    ("mirror", "Create a mirror"),
+    ("check-attrs", "Look for additional resources in attributes"),
+    ("fix-query", "Fix filenames with query strings"),
+    ("normalize-html", "Fix code and rename files to .html"),
+    ("php-rename", "Rename .html files to .php"),
+    ("pretty-print", "Format HTML/PHP/ASP code with indentation"),
+    ("php-includes", "Extract common blocks into PHP include files")
+)
+# Attributes proposed by default to check-attrs
+_DEFAULT_ATTRS = "data-lazyload,data-bkg,data-src,data-image-src"
+
+# Seconds between two scans of the pages downloaded by a running mirror (overlap option)
+_OVERLAP_POLL_SECONDS = 2
+
+# Domains are processed in parallel threads, which must not interleave their messages
+_print_lock = threading.Lock()
+
+
+class _DomainOutput:
+    """
+    Stands in for sys.stdout while domains are processed in parallel threads. What a domain
+    prints (including the messages of helpers and php_refactor) is written one complete line
+    at a time under _print_lock, prefixed with the domain, so lines never interleave.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def start(self, prefix):
+        """Routes the output of the current thread, prefixing each line."""
+        self._local.prefix = prefix
+        self._local.pending = ''
+
+    def finish(self):
+        """Writes what is left of the current thread's last line and stops prefixing."""
+        if getattr(self._local, 'pending', ''):
+            self.write('\n')
+        self._local.prefix = None
+
+    def write(self, text):
+        prefix = getattr(self._local, 'prefix', None)
+        if prefix is None:
+            with _print_lock:
+                return self._stream.write(text)
+        *lines, self._local.pending = (self._local.pending + text).split('\n')
+        if lines:
+            with _print_lock:
+                self._stream.write(''.join(f"{prefix}{line}\n" for line in lines))
+                self._stream.flush()
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def load_config(path):
+    """
+    Reads an ini configuration file into plain dictionaries. The result is cached as
+    JSON next to the file (path + ".cache") together with the file's modification time
+    and size, so later runs load it without parsing while the file is unchanged.
+
+    Args:
+        path (str): Path of the configuration file
+
+    Returns:
+        dict: Section name -> {option: value}, with the DEFAULT options merged into every
+            section; empty if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    stamp = [st.st_mtime_ns, st.st_size]
+
+    cache_path = path + ".cache"
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache["stamp"] == stamp:
+            return cache["sections"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    config = configparser.ConfigParser()
+    config.read(path)
+    sections = {name: dict(config[name]) for name in config}
+
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({"stamp": stamp, "sections": sections}, f)
+    except OSError:
+        pass
+    return sections
+
+
+# prompt_toolkit is a large import, so it is only loaded when a dialog is shown
+def _ask_checkbox(**kwargs):
+    """Shows a prompt_toolkit checkboxlist_dialog and returns the selected values (None if cancelled)."""
+    from prompt_toolkit.shortcuts import checkboxlist_dialog
+    return checkboxlist_dialog(**kwargs).run()
+
+
+def _ask_input(**kwargs):
+    """Shows a prompt_toolkit input_dialog and returns the text entered (None if cancelled)."""
+    from prompt_toolkit.shortcuts import input_dialog
+    return input_dialog(**kwargs).run()
+
+
+def form_dialog(title, fields, ok_text="OK", cancel_text="Cancel"):
+    """
+    Builds a dialog asking several values at once, one text field per value, in the style
+    of prompt_toolkit's input_dialog.
+
+    Args:
+        title (str): Title of the dialog
+        fields (list): (key, label, default) of each field
+        ok_text (str): Text of the confirmation button
+        cancel_text (str): Text of the cancel button
+
+    Returns:
+        Application: The dialog; run() returns {key: text} or None if cancelled
+    """
+    from prompt_toolkit.application import Application
+    from prompt_toolkit.application.current import get_app
+    from prompt_toolkit.key_binding.bindings.focus import focus_next, focus_previous
+    from prompt_toolkit.key_binding.defaults import load_key_bindings
+    from prompt_toolkit.key_binding.key_bindings import KeyBindings, merge_key_bindings
+    from prompt_toolkit.layout import HSplit, Layout
+    from prompt_toolkit.layout.dimension import D
+    from prompt_toolkit.widgets import Button, Dialog, Label, TextArea
+
+    def accept(buffer):
+        # Enter moves to the next field, and from the last one to the confirmation button
+        get_app().layout.focus_next()
+        return True
+
+    def ok_handler():
+        get_app().exit(result={key: textfield.text for key, textfield in textfields.items()})
+
+    textfields = {key: TextArea(text=default, multiline=False, accept_handler=accept)
+                  for key, label, default in fields}
+    body = []
+    for key, label, default in fields:
+        body += [Label(text=label, dont_extend_height=True), textfields[key]]
+
+    dialog = Dialog(
+        title=title,
+        body=HSplit(body, padding=D(preferred=1, max=1)),
+        buttons=[Button(text=ok_text, handler=ok_handler),
+                 Button(text=cancel_text, handler=lambda: get_app().exit())],
+        with_background=True)
+
+    bindings = KeyBindings()
+    bindings.add("tab")(focus_next)
+    bindings.add("s-tab")(focus_previous)
+    return Application(
+        layout=Layout(dialog),
+        key_bindings=merge_key_bindings([load_key_bindings(), bindings]),
+        mouse_support=True,
+        full_screen=True)
+
+
+@lru_cache(maxsize=8192)
+def _parsed(url):
+    """
+    urllib.parse.urlparse, memoized: the same extra URLs are looked up again by every
+    scan of a running mirror (overlap option) and by the final check-attrs pass.
+    """
+    return urllib.parse.urlparse(url)
+
+
+def local_path_for(url, mirror_path, query_sep="?"):
+    """
+    Returns the path where wget -x -P mirror_path saves a URL: mirror_path/host/path,
+    with index.html for directory URLs.
+
+    Args:
+        url (str): The downloaded URL
+        mirror_path (str): Directory where the mirrors are saved
+        query_sep (str): Character wget puts before the query string in file names
+            ("?", or "@" with --restrict-file-names=windows)
+
+    Returns:
+        str: Path of the local copy
+    """
+    parsed = _parsed(url)
+    path = parsed.path
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    local_path = os.path.join(mirror_path, parsed.netloc, *path.lstrip('/').split('/'))
+    if parsed.query:
+        local_path += query_sep + parsed.query
+    return local_path
+
+
+def _start_wget(wget_cmd, urls):
+    """
+    Starts a wget that downloads a list of URLs given on its standard input, without
+    waiting for it to finish.
+
+    Args:
+        wget_cmd (list): The wget command, which must read its URLs from stdin ("-i", "-")
+        urls (iterable): URLs to download
+
+    Returns:
+        subprocess.Popen: The running wget process
+    """
+    process = subprocess.Popen(wget_cmd, stdin=subprocess.PIPE)
+    # wget reads the whole list before it starts downloading
+    process.stdin.write("\n".join(urls).encode())
+    process.stdin.close()
+    return process
+
+
+def _download_extra_urls(extra_urls, mirror_path, download_path):
+    """
+    Starts downloading the URLs found by check_attrs that are not on disk yet.
+
+    Args:
+        extra_urls (set): URLs to download
+        mirror_path (str): Directory where the mirrors are saved
+        download_path (str): Directory of the domain's mirror
+
+    Returns:
+        list: The running wget processes (subprocess.Popen)
+    """
+    # Separate URLs into page files and static resources
+    page_urls = set()
+    static_urls = set()
+    
+    for url in extra_urls:
+        # Check if the URL points to a page file (HTML, ASP, PHP, etc.)
+        (page_urls if _PAGE_RE.search(url) else static_urls).add(url)
+
+    # URLs already downloaded (e.g. by the mirror) are skipped. The existing files are
+    # listed in a single walk instead of checking every URL on disk
+    existing_files = frozenset(iter_files(download_path))
+    static_urls = {url for url in static_urls
+                   if local_path_for(url, mirror_path) not in existing_files}
+    # --adjust-extension may have added .html to the name of a page
+    page_urls = {url for url in page_urls
+                 if (local_path := local_path_for(url, mirror_path, "@")) not in existing_files
+                 and local_path + ".html" not in existing_files}
+    
+    # Each group of URLs is fetched by a single wget reading the list from stdin (-i -),
+    # which reuses its connections instead of paying a process start and handshake per URL.
+    # Both groups are downloaded at the same time
+    downloads = []
+    if static_urls:
+        # Download static resources with basic wget
+        downloads.append(_start_wget(["wget", "-x", "-P", mirror_path, "-i", "-"], static_urls))
+
+    if page_urls:
+        # Download page files with more options similar to mirror mode
+        wget_cmd = [
+            "wget",
+            "--convert-links",
+            "--adjust-extension",
+            "--page-requisites",
+            "--no-parent",
+            "--restrict-file-names=ascii,windows",
+            "-x",  # Keep directory structure
+            "-P", mirror_path,
+            "-i", "-"
+        ]
+        downloads.append(_start_wget(wget_cmd, page_urls))
+
+    return downloads
+
+
+def _prefetch_extra_urls(mirror, domain, download_path, attrs, mirror_path):
+    """
+    While the mirror is running, scans the pages as they arrive and starts downloading the
+    extra URLs they reference, so the scan and those downloads overlap the mirror.
+    Pages are only read: wget may still be writing them, and converts their links when
+    it finishes, so the full check_attrs pass still runs after the mirror.
+    Returns once the mirror has finished; if the scan fails, the mirror and the downloads
+    are stopped before the error is raised.
+
+    Args:
+        mirror (subprocess.Popen): The running wget --mirror process
+        domain (str): The website domain (e.g., 'https://example.com')
+        download_path (str): Directory of the domain's mirror
+        attrs (str): Comma-separated attributes to search
+        mirror_path (str): Directory where the mirrors are saved
+    """
+    # Size and modification time of each scanned page: a page still being written when it
+    # was scanned is scanned again once it has changed
+    scanned = {}
+    requested = set()
+    downloads = []
+    try:
+        while mirror.poll() is None:
+            time.sleep(_OVERLAP_POLL_SECONDS)
+            new_files = []
+            for path in iter_files(download_path, (".html", ".php", ".asp")):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if scanned.get(path) != (st.st_size, st.st_mtime_ns):
+                    scanned[path] = (st.st_size, st.st_mtime_ns)
+                    new_files.append(path)
+            if not new_files:
+                continue
+            extra_urls = check_attrs(domain, download_path, attrs, files=new_files, rewrite=False,
+                                     quiet=True) - requested
+            requested |= extra_urls
+            downloads += _download_extra_urls(extra_urls, mirror_path, download_path)
+    except BaseException:
+        # Nothing else would stop or reap them
+        for process in (mirror, *downloads):
+            process.terminate()
+        raise
+    finally:
+        mirror.wait()
+        for download in downloads:
+            download.wait()
+
+
+def process_domain(domain, options, mirror_path, attrs, php_includes_options, overlap=False):
+    """
+    Runs the selected operations on a single domain.
+
+    Args:
+        domain (str): The website address, with or without scheme
+        options (list): Operations selected by the user
+        mirror_path (str): Directory where the mirrors are saved
+        attrs (str | None): Comma-separated attributes to search with check-attrs, None if not selected
+        php_includes_options (dict): Options for extract_php_includes
+        overlap (bool): Look for the extra resources of check-attrs while the mirror is running
+    """
+    # Add https:// if the scheme is not present
+    if not domain.startswith(("http://", "https://")):
+        domain = "https://" + domain
+    base_url = domain
+
+    # wget saves the site in a directory named after the host, whatever the scheme
+    download_dir = domain.removeprefix("https://").removeprefix("http://")
+
+    # Use the mirror_path from config
+    download_path = os.path.join(mirror_path, download_dir)
+
+    if 'mirror' in options:
+        # 1. Initial execution of wget for site mirroring
+        wget_cmd = [
+            "wget",
+            "--mirror",
+            "--convert-links",
+            "--adjust-extension",
+            "--page-requisites",
+            "--no-parent",
+            "--restrict-file-names=ascii,windows",
+            "-P", mirror_path,  # Set the download directory to download_path
+            base_url
+        ]
+        mirror = subprocess.Popen(wget_cmd)
+        if attrs is not None and overlap:
+            _prefetch_extra_urls(mirror, domain, download_path, attrs, mirror_path)
+        mirror.wait()
+
+    if attrs is not None:
+        extra_urls = check_attrs(domain, download_path, attrs)
+
+        print(f"URLs found: {extra_urls}...")
+
+        for download in _download_extra_urls(extra_urls, mirror_path, download_path):
+            download.wait()
+    
+    # Apply user options to all files, including both original and newly downloaded ones.
+    # fix-query, normalize-html, php-rename and pretty-print share a single walk of the
+    # directory and a single read/parse/write per file
+    transforms = {op for op in options if op in ("fix-query", "normalize-html", "php-rename", "pretty-print")}
+    if "php-includes" in options:
+        # Pretty print once, after the includes have been extracted
+        transforms.discard("pretty-print")
+    # Stamps of the pretty printed pages, kept outside every downloaded site
+    cache_dir = os.path.join(mirror_path, ".pretty_cache")
+    if transforms:
+        apply_transforms(domain, download_path, transforms, cache_dir=cache_dir)
+    
+    if "php-includes" in options:
+        # php_refactor pulls in BeautifulSoup, which nothing else needs any more
+        from php_refactor import extract_php_includes
+        extract_php_includes(
+            domain, 
+            download_path,
+            min_block_size=php_includes_options.get('min_block_size', 50),
+            similarity_threshold=php_includes_options.get('similarity_threshold', 0.9),
+            min_occurrences=php_includes_options.get('min_occurrences', 2),
+            debug=True  # Enable debug mode
+        )
+        if "pretty-print" in options:
+            pretty_print(domain, download_path, cache_dir=cache_dir)
 
 
 def main():
     # Read configuration from config.ini
-    config = configparser.ConfigParser()
-    config.read('config.ini')
-    mirror_path = config.get('DEFAULT', 'mirror_path', fallback='.')
+    config = load_config('config.ini')
+    mirror_path = config.get('DEFAULT', {}).get('mirror_path', '.')
 
     domains = []
-    domains_config = config.get('domains', 'domains_to_mirror', fallback='')
+    domains_config = config.get('domains', {}).get('domains_to_mirror', '')
     
-    available_domains = []
-    if domains_config:
-        available_domains = domains_config.split(',')
+    # Domains are separated by commas; spaces, newlines and empty entries are ignored
+    available_domains = [d.strip() for d in domains_config.split(',') if d.strip()]
     
     if available_domains:
-        domains = checkboxlist_dialog(
+        domains = _ask_checkbox(
             title="Domain",
             ok_text="Proceed",
             cancel_text="Cancel",
             text="Choose one or more domains",
-                values=[(d, d) for d in available_domains]).run()
+                values=[(d, d) for d in available_domains])
 
     if not domains or len(domains) == 0:
         domains = []
-        domain = input_dialog(
+        domain = _ask_input(
             title='Domain',
             ok_text="Proceed",
             cancel_text="Cancel",
-            text="Enter the complete website address (e.g. www.example.org)").run()
+            text="Enter the complete website address (e.g. www.example.org)")
         if domain:
             domains.append(domain)
 
     if not domains or len(domains) == 0:
         return
 
-    options = checkboxlist_dialog(
+    options = _ask_checkbox(
         title="Operations to execute",
         ok_text="Proceed",
         cancel_text="Cancel",
         text=f"What do you want to do with {', '.join(domains)}?",
-        values=[
-            ("mirror", "Create a mirror"),
-            ("check-attrs", "Look for additional resources in attributes"),
-            ("fix-query", "Fix filenames with query strings"),
-            ("normalize-html", "Fix code and rename files to .html"),
-            ("php-rename", "Rename .html files to .php"),
-            ("pretty-print", "Format HTML/PHP/ASP code with indentation"),
-            ("php-includes", "Extract common blocks into PHP include files")
-        ]
-    ).run()
+        values=list(_OPERATION_CHOICES)
+    )
 
     if not options or len(options) == 0:
         return
 
     option_check_attrs = False
-    attrs = "data-lazyload,data-bkg,data-src,data-image-src"
+    attrs = _DEFAULT_ATTRS
     if options and 'check-attrs' in options:
         option_check_attrs = True
-        attrs = input_dialog(
+        attrs = _ask_input(
             title='Domain',
             text="List additional attributes to search for resources, separated by commas. (e.g. data-src,data-attr)",
-            default=attrs).run()
+            default=attrs)
     
     # PHP includes options
     php_includes_options = {}
     if options and 'php-includes' in options:
-        if config.has_section('PHP_Includes'):
+        if 'PHP_Includes' in config:
+            php_includes_config = config['PHP_Includes']
             php_includes_options = {
-                'min_block_size': config.getint('PHP_Includes', 'min_block_size', fallback=50),
-                'similarity_threshold': config.getfloat('PHP_Includes', 'similarity_threshold', fallback=0.9),
-                'min_occurrences': config.getint('PHP_Includes', 'min_occurrences', fallback=2)
+                'min_block_size': int(php_includes_config.get('min_block_size', 50)),
+                'similarity_threshold': float(php_includes_config.get('similarity_threshold', 0.9)),
+                'min_occurrences': int(php_includes_config.get('min_occurrences', 2))
             }
         else:
-            min_block_size = input_dialog(
-                title='Minimum block size',
-                text="Minimum size in characters to consider a block (default: 50)",
-                default="50").run()
+            # All the options are asked in a single form; empty fields (or Cancel) keep the default
+            answers = form_dialog(
+                title='PHP includes',
+                ok_text="Proceed",
+                cancel_text="Cancel",
+                fields=[
+                    ('min_block_size',
+                     "Minimum size in characters to consider a block (default: 50)", "50"),
+                    ('similarity_threshold',
+                     "Threshold for considering blocks similar (0.0-1.0). A value of 1.0 means identical, 0.9 means 90% similar (default: 0.9)",
+                     "0.9"),
+                    ('min_occurrences',
+                     "Minimum number of occurrences to extract a block (default: 2)", "2"),
+                ]).run() or {}
+            min_block_size = answers.get('min_block_size')
             php_includes_options['min_block_size'] = int(min_block_size) if min_block_size else 50
-            
-            similarity_threshold = input_dialog(
-                title='Similarity threshold',
-                text="Threshold for considering blocks similar (0.0-1.0). A value of 1.0 means identical, 0.9 means 90% similar (default: 0.9)",
-                default="0.9").run()
+            similarity_threshold = answers.get('similarity_threshold')
             php_includes_options['similarity_threshold'] = float(similarity_threshold) if similarity_threshold else 0.9
-            
-            min_occurrences = input_dialog(
-                title='Minimum occurrences',
-                text="Minimum number of occurrences to extract a block (default: 2)",
-                default="2").run()
+            min_occurrences = answers.get('min_occurrences')
             php_includes_options['min_occurrences'] = int(min_occurrences) if min_occurrences else 2
 
-    for domain in domains:
-
-        # Add https:// if the scheme is not present
-        if not urllib.parse.urlparse(domain).scheme:
-            domain = "https://" + domain
-            base_url = domain
-
-            download_dir = domain.replace("https://", "")
-
-            # Use the mirror_path from config
-            download_path = os.path.join(mirror_path, download_dir)
-
-            if 'mirror' in options:
-                # 1. Initial execution of wget for site mirroring
-                wget_cmd = [
-                    "wget",
-                    "--mirror",
-                    "--convert-links",
-                    "--adjust-extension",
-                    "--page-requisites",
-                    "--no-parent",
-                    "--restrict-file-names=ascii,windows",
-                    "-P", mirror_path,  # Set the download directory to download_path
-                    base_url
-                ]
-                subprocess.run(wget_cmd)
-
-            if option_check_attrs:
-                extra_urls = check_attrs(domain, download_path, attrs)
-
-                print(f"URLs found: {extra_urls}...")
-
-                # Separate URLs into page files and static resources
-                page_urls = set()
-                static_urls = set()
-                
-                for url in extra_urls:
-                    # Check if the URL points to a page file (HTML, ASP, PHP, etc.)
-                    if re.search(r'\.(html|htm|asp|php|jsp|aspx|do|cgi)(\?|$)', url, flags=re.IGNORECASE):
-                        page_urls.add(url)
-                    else:
-                        static_urls.add(url)
-                
-                # Download static resources with basic wget
-                for url in static_urls:
-                    subprocess.run(["wget", "-x", "-P", mirror_path, url])
-                
-                # Download page files with more options similar to mirror mode
-                for url in page_urls:
-                    wget_cmd = [
-                        "wget",
-                        "--convert-links",
-                        "--adjust-extension",
-                        "--page-requisites",
-                        "--no-parent",
-                        "--restrict-file-names=ascii,windows",
-                        "-x",  # Keep directory structure
-                        "-P", mirror_path,
-                        url
-                    ]
-                    subprocess.run(wget_cmd)
-            
-            # Apply user options to all files, including both original and newly downloaded ones
-            if 'fix-query' in options:
-                fix_query_strings(domain, download_path)
-                
-            if "normalize-html" in options:
-                normalize_html(domain, download_path)
-
-            if "php-rename" in options:
-                php_rename(domain, download_path)
-                
-            if "pretty-print" in options:
-                pretty_print(domain, download_path)
-            
-            if "php-includes" in options:
-                extract_php_includes(
-                    domain, 
-                    os.path.join(mirror_path, download_dir),
-                    min_block_size=php_includes_options.get('min_block_size', 50),
-                    similarity_threshold=php_includes_options.get('similarity_threshold', 0.9),
-                    min_occurrences=php_includes_options.get('min_occurrences', 2),
-                    debug=True  # Enable debug mode
-                )
-                if "pretty-print" in options:
-                    pretty_print(domain, download_path)
+    max_workers = int(config.get('DEFAULT', {}).get('max_workers', 4))
+    overlap = configparser.ConfigParser.BOOLEAN_STATES.get(
+        config.get('DEFAULT', {}).get('overlap', 'no').lower(), False)
+    # Domains are mirrored concurrently: wget spends most of its time waiting on the network.
+    # Their lines are prefixed with the domain when there is more than one
+    stdout = sys.stdout
+    output = _DomainOutput(stdout)
+
+    def run_domain(domain):
+        output.start(f"[{domain}] " if len(domains) > 1 else "")
+        try:
+            process_domain(domain, options, mirror_path, attrs if option_check_attrs else None,
+                           php_includes_options, overlap)
+        finally:
+            output.finish()
+
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_domain, domain) for domain in domains]
+            for future in as_completed(futures):
+                # Re-raise the errors of the domain
+                future.result()
+    finally:
+        sys.stdout = stdout
 
 
 if __name__ == '__main__':
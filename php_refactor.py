@@ -2,10 +2,104 @@
 
 import os
 import re
+import random
+import shutil
+import tempfile
+import zlib
 import hashlib
 import difflib
-from collections import defaultdict
-from bs4 import BeautifulSoup
+import warnings
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from functools import cached_property, lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, XMLParsedAsHTMLWarning
+from lxml import etree
+from helpers import HTML_PARSER, iter_files, map_files, mask_server_code, unmask_server_code
+
+# MinHash/LSH settings used to find candidate pairs of similar blocks.
+# Short shingles and two-row bands keep recall high for blocks that only
+# differ by a few tokens; every candidate is still verified with difflib.
+_SHINGLE_SIZE = 3
+_LSH_BANDS = 16
+_LSH_ROWS = 2
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(0)
+_MINHASH_PERMUTATIONS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(_MINHASH_PRIME))
+                         for _ in range(_LSH_BANDS * _LSH_ROWS)]
+_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+_NAV_CLASS_RE = re.compile(r'(nav|menu|header|footer)', re.I)
+# Pattern for CSS link tags (specifically looking for the pattern mentioned by the user)
+_CSS_LINKS_RE = re.compile(r'<link\s+href="/css/style\.css"[^>]*>\s*<link\s+href="/css/responsive\.css"[^>]*>\s*<link\s+href="/css/fotorama\.dev\.css"[^>]*>\s*<link\s+href="/images/favicon\.ico"[^>]*>', re.DOTALL)
+_LINK_GROUP_RE = re.compile(r'(<link[^>]+>\s*){3,}', re.DOTALL)  # 3 or more consecutive link tags
+_LINK_TAG_RE = re.compile(r'<link[^>]+>')
+_PHP_BLOCK_RE = re.compile(r'<\?php\s+(.+?)\s+\?>', re.DOTALL)
+_WS_RE = re.compile(r'\s+')
+_START_TAG_RE = re.compile(r'\s*<([a-zA-Z][\w:-]*)')
+
+# BeautifulSoup uses the lxml builder. lxml would turn <?php ... ?> into a comment and escape it
+# in attribute values, so PHP code is masked before parsing (see _masked_soup) and put back in
+# any markup taken from the tree (see _unmask)
+_SOUP_PARSER = 'lxml'
+# XHTML pages (starting with <?xml ...?>) are parsed as HTML on purpose, like every other page
+warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
+
+# Only the elements extract_potential_blocks looks at (with everything inside them) are parsed
+_BLOCK_STRAINER = SoupStrainer(['script', 'nav', 'div', 'header', 'footer', 'head', 'link'])
+
+# Potential navigation containers of a file (menu content matching), evaluated by libxml2
+_MENU_CONTAINERS_XPATH = etree.XPath(
+    " | ".join("//{}[re:test(@class, 'nav|menu', 'i')]".format(name) for name in ('nav', 'div', 'ul')),
+    namespaces={'re': 'http://exslt.org/regular-expressions'})
+_NAV_OR_LIST_XPATH = etree.XPath("//nav | //ul")
+
+
+@dataclass
+class BlockMeta:
+    """
+    Data derived from a common block's content, computed on first use and shared
+    by every identical copy of the block (see block_meta).
+    """
+    content: str
+    
+    @cached_property
+    def _parsed(self):
+        return _masked_soup(self.content)
+    
+    @cached_property
+    def soup(self):
+        return self._parsed[0]
+    
+    def unmask(self, markup):
+        return _unmask(markup, self._parsed[1])
+    
+    @cached_property
+    def root(self):
+        # The block's outermost element (the soup itself is the '[document]' the lxml
+        # builder wraps it in), or None if the block does not start with a tag
+        match = _START_TAG_RE.match(self.content)
+        return self.soup.find(match.group(1).lower()) if match else None
+    
+    @cached_property
+    def link_tags(self):
+        return _LINK_TAG_RE.findall(self.content)
+    
+    @cached_property
+    def fingerprint(self):
+        return element_fingerprint(self.soup if self.root is None else self.root)
+    
+    @cached_property
+    def menu_items(self):
+        return [(a.get('href', ''), a.get_text().strip()) for a in self.soup.find_all('a')]
+    
+    @cached_property
+    def menu_items_set(self):
+        return frozenset(self.menu_items)
+    
+    @cached_property
+    def normalized_content(self):
+        return _WS_RE.sub(' ', self.content)
 
 
 class PHPRefactor:
@@ -28,6 +122,7 @@ class PHPRefactor:
         self.php_files = []
         self.file_contents = {}
         self.common_blocks = defaultdict(list)
+        self._dirty_files = set()
         self.includes_dir = os.path.join(directory, 'includes')
         
     def scan_directory(self):
@@ -35,217 +130,124 @@ class PHPRefactor:
         Scan the directory for PHP files and load their contents.
         """
         print(f"Scanning directory: {self.directory}")
-        for root, _, files in os.walk(self.directory):
-            for file in files:
-                if file.endswith('.php'):
-                    file_path = os.path.join(root, file)
-                    self.php_files.append(file_path)
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        self.file_contents[file_path] = f.read()
+        self.php_files.extend(iter_files(self.directory, '.php'))
+        
+        # Reading is I/O bound, so the files are loaded from a thread pool
+        with ThreadPoolExecutor() as executor:
+            for file_path, content in zip(self.php_files, executor.map(read_file, self.php_files)):
+                self.file_contents[file_path] = content
         
         print(f"Found {len(self.php_files)} PHP files")
         return self.php_files
     
-    def _extract_potential_blocks(self, content):
+    def _flush_files(self):
         """
-        Extract potential blocks from a PHP file using BeautifulSoup.
-        This extracts HTML blocks, script tags, and other common elements.
-        
-        Args:
-            content (str): PHP file content
-            
-        Returns:
-            list: List of potential blocks with their metadata
+        Write every modified PHP file back to disk, atomically replacing the original.
         """
-        blocks = []
-        
-        # Try to parse the content with BeautifulSoup
-        try:
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Extract script tags
-            for script in soup.find_all('script'):
-                if len(str(script)) >= self.min_block_size:
-                    blocks.append({
-                        'type': 'script',
-                        'content': str(script),
-                        'hash': hashlib.md5(str(script).encode()).hexdigest()
-                    })
-            
-            # Extract navigation menus (common patterns)
-            for nav in soup.find_all(['nav', 'div'], class_=re.compile(r'(nav|menu|header|footer)', re.I)):
-                if len(str(nav)) >= self.min_block_size:
-                    blocks.append({
-                        'type': 'navigation',
-                        'content': str(nav),
-                        'hash': hashlib.md5(str(nav).encode()).hexdigest()
-                    })
-                    
-            # Extract headers
-            header = soup.find('header')
-            if header and len(str(header)) >= self.min_block_size:
-                blocks.append({
-                    'type': 'header',
-                    'content': str(header),
-                    'hash': hashlib.md5(str(header).encode()).hexdigest()
-                })
-                
-            # Extract footers
-            footer = soup.find('footer')
-            if footer and len(str(footer)) >= self.min_block_size:
-                blocks.append({
-                    'type': 'footer',
-                    'content': str(footer),
-                    'hash': hashlib.md5(str(footer).encode()).hexdigest()
-                })
-            
-            # Extract head content - specifically targeting CSS and favicon links
-            head = soup.find('head')
-            if head:
-                # Find all link tags in the head
-                link_tags = head.find_all('link')
-                
-                # Look for CSS and favicon links specifically
-                css_favicon_links = []
-                for link in link_tags:
-                    if 'rel' in link.attrs and link['rel'] == 'stylesheet' or \
-                       'type' in link.attrs and link['type'] == 'image/x-icon' or \
-                       'href' in link.attrs and ('.css' in link['href'] or 'favicon' in link['href']):
-                        css_favicon_links.append(link)
-                
-                # If we have consecutive CSS/favicon links, group them
-                if len(css_favicon_links) >= 2:
-                    # Find consecutive sequences
-                    i = 0
-                    while i < len(css_favicon_links):
-                        # Start a new group
-                        group = [css_favicon_links[i]]
-                        j = i + 1
-                        
-                        # Find consecutive siblings
-                        while j < len(css_favicon_links):
-                            # Check if they are adjacent in the original HTML
-                            if are_adjacent_siblings(css_favicon_links[j-1], css_favicon_links[j]):
-                                group.append(css_favicon_links[j])
-                                j += 1
-                            else:
-                                break
-                        
-                        # If we have a group of 2 or more, add it
-                        if len(group) >= 2:
-                            group_content = ''.join(str(tag) for tag in group)
-                            if len(group_content) >= self.min_block_size:
-                                blocks.append({
-                                    'type': 'css_links',
-                                    'content': group_content,
-                                    'hash': hashlib.md5(group_content.encode()).hexdigest()
-                                })
-                        
-                        i = j
-                
-                # Also look for meta tags groups
-                meta_tags = head.find_all('meta')
-                if len(meta_tags) >= 2:
-                    i = 0
-                    while i < len(meta_tags):
-                        group = [meta_tags[i]]
-                        j = i + 1
-                        
-                        while j < len(meta_tags):
-                            if are_adjacent_siblings(meta_tags[j-1], meta_tags[j]):
-                                group.append(meta_tags[j])
-                                j += 1
-                            else:
-                                break
-                        
-                        if len(group) >= 2:
-                            group_content = ''.join(str(tag) for tag in group)
-                            if len(group_content) >= self.min_block_size:
-                                blocks.append({
-                                    'type': 'meta_tags',
-                                    'content': group_content,
-                                    'hash': hashlib.md5(group_content.encode()).hexdigest()
-                                })
-                        
-                        i = j
-            
-            # Direct pattern matching for common blocks
-            # This is a more targeted approach for specific patterns like CSS links
-            raw_html = str(soup)
-            
-            # Pattern for CSS link tags (specifically looking for the pattern mentioned by the user)
-            css_pattern = r'<link\s+href="/css/style\.css"[^>]*>\s*<link\s+href="/css/responsive\.css"[^>]*>\s*<link\s+href="/css/fotorama\.dev\.css"[^>]*>\s*<link\s+href="/images/favicon\.ico"[^>]*>'
-            for match in re.finditer(css_pattern, raw_html, re.DOTALL):
-                match_content = match.group(0)
-                blocks.append({
-                    'type': 'css_links',
-                    'content': match_content,
-                    'hash': hashlib.md5(match_content.encode()).hexdigest()
-                })
-            
-            # More general pattern for consecutive link tags
-            link_pattern = r'(<link[^>]+>\s*){3,}'  # 3 or more consecutive link tags
-            for match in re.finditer(link_pattern, raw_html, re.DOTALL):
-                match_content = match.group(0)
-                if len(match_content) >= self.min_block_size:
-                    blocks.append({
-                        'type': 'link_group',
-                        'content': match_content,
-                        'hash': hashlib.md5(match_content.encode()).hexdigest()
-                    })
-                
-        except Exception as e:
-            print(f"Error parsing file with BeautifulSoup: {e}")
-            
-        # Also try regex-based extraction for PHP blocks
-        php_blocks = re.findall(r'<\?php\s+(.+?)\s+\?>', content, re.DOTALL)
-        for block in php_blocks:
-            if len(block) >= self.min_block_size:
-                blocks.append({
-                    'type': 'php_code',
-                    'content': f'<?php {block} ?>',
-                    'hash': hashlib.md5(block.encode()).hexdigest()
-                })
-                
-        return blocks
+        for file_path in self._dirty_files:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(file_path))
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(self.file_contents[file_path])
+                shutil.copymode(file_path, tmp_path)
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        self._dirty_files.clear()
     
     def identify_common_blocks(self):
         """
         Identify common blocks across all PHP files.
         """
         print("Identifying common blocks...")
-        all_blocks = []
         
-        # Extract blocks from each file
-        for file_path, content in self.file_contents.items():
-            blocks = self._extract_potential_blocks(content)
+        # Blocks are kept as parallel lists indexed by block number, so the pairwise
+        # loop below only does list indexing instead of per-block dict lookups
+        types = []
+        contents = []
+        hashes = []
+        files = []
+        
+        # Extract blocks from each file, spreading the parsing over worker processes.
+        # String hashes are salted per interpreter, so they are computed here.
+        extract = partial(extract_potential_blocks, min_block_size=self.min_block_size)
+        for file_path, (blocks, messages) in zip(self.file_contents, map_files(extract, self.file_contents.values())):
+            for message in messages:
+                print(message)
             for block in blocks:
-                block['file'] = file_path
-                all_blocks.append(block)
+                types.append(block['type'])
+                contents.append(block['content'])
+                hashes.append(hash(block['content']))
+                files.append(file_path)
+        lengths = [len(content) for content in contents]
+        
+        # Blocks with identical content are grouped by their hash, without running difflib.
+        # The first copy of each distinct block stands for all of its copies below.
+        exact_groups = defaultdict(list)
+        for i, block_hash in enumerate(hashes):
+            exact_groups[block_hash].append(i)
+        representatives = [copies[0] for copies in exact_groups.values()]
+        char_counts = {i: Counter(contents[i]) for i in representatives}
+        
+        # Index every distinct block by its LSH bands so only blocks sharing a band are compared
+        block_bands = {i: minhash_bands(contents[i]) for i in representatives}
+        buckets = defaultdict(list)
+        for i, bands in block_bands.items():
+            for band in bands:
+                buckets[band].append(i)
         
         # Group similar blocks
+        threshold = self.similarity_threshold
         processed_hashes = set()
-        for i, block1 in enumerate(all_blocks):
-            if block1['hash'] in processed_hashes:
+        for i in representatives:
+            if hashes[i] in processed_hashes:
                 continue
+            processed_hashes.add(hashes[i])
+            
+            # Start with every identical copy of the block, at most one per file
+            similar = []
+            seen_files = set()
+            for k in exact_groups[hashes[i]]:
+                if files[k] not in seen_files:
+                    seen_files.add(files[k])
+                    similar.append(k)
                 
-            similar_blocks = [block1]
-            for block2 in all_blocks[i+1:]:
-                # Skip if already processed or from the same file
-                if block2['hash'] in processed_hashes or block1['file'] == block2['file']:
+            # Blocks whose lengths differ too much can never reach the threshold
+            # (ratio() is at most 2 * shorter length / total length), so candidates
+            # outside this length window are dropped while they are collected
+            min_length = lengths[i] * threshold / (2 - threshold)
+            max_length = lengths[i] * (2 - threshold) / threshold if threshold else float('inf')
+            candidates = sorted({j for band in block_bands[i] for j in buckets[band]
+                                 if j > i and min_length <= lengths[j] <= max_length})
+            for j in candidates:
+                # Skip if already processed (this includes identical copies) or only found in the same file
+                if hashes[j] in processed_hashes or all(files[k] == files[i] for k in exact_groups[hashes[j]]):
                     continue
-                    
+                
+                # Upper bound of ratio() from the characters both blocks have in common
+                # (what quick_ratio() computes, but from counts made once per block)
+                common = sum((char_counts[i] & char_counts[j]).values())
+                if 2 * common < threshold * (lengths[i] + lengths[j]):
+                    continue
+                
                 # Check similarity using difflib
-                similarity = difflib.SequenceMatcher(None, block1['content'], block2['content']).ratio()
-                if similarity >= self.similarity_threshold:
-                    similar_blocks.append(block2)
-                    processed_hashes.add(block2['hash'])
+                if difflib.SequenceMatcher(None, contents[i], contents[j], autojunk=False).ratio() >= threshold:
+                    # The similar block brings its own identical copies along
+                    copy_files = {files[i]}
+                    for k in exact_groups[hashes[j]]:
+                        if files[k] not in copy_files:
+                            copy_files.add(files[k])
+                            similar.append(k)
+                    processed_hashes.add(hashes[j])
             
             # If we found enough similar blocks, add to common_blocks
-            if len(similar_blocks) >= self.min_occurrences:
-                block_id = f"{block1['type']}_{len(self.common_blocks)}"
-                self.common_blocks[block_id] = similar_blocks
-                processed_hashes.add(block1['hash'])
+            if len(similar) >= self.min_occurrences:
+                block_id = f"{types[i]}_{len(self.common_blocks)}"
+                self.common_blocks[block_id] = [
+                    {'type': types[k], 'content': contents[k], 'hash': hashes[k], 'file': files[k]}
+                    for k in similar
+                ]
         
         print(f"Found {len(self.common_blocks)} common blocks")
         return self.common_blocks
@@ -272,13 +274,16 @@ class PHPRefactor:
             content = blocks[0]['content']
             block_type = blocks[0]['type']
             
+            # Encode once for both the filename hash and the file itself
+            data = content.encode('utf-8')
+            
             # Create a filename for the include
-            include_filename = f"{block_type}_{hashlib.md5(content.encode()).hexdigest()[:8]}.php"
+            include_filename = f"{block_type}_{hashlib.md5(data).hexdigest()[:8]}.php"
             include_path = os.path.join(self.includes_dir, include_filename)
             
             # Write the include file
-            with open(include_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            with open(include_path, 'wb') as f:
+                f.write(data)
                 
             include_files[block_id] = include_path
             print(f"Created include file: {include_path}")
@@ -308,6 +313,8 @@ class PHPRefactor:
                 for i, block in enumerate(blocks):
                     print("  {}. {}".format(i+1, os.path.basename(block['file'])))
         
+        # Collect the blocks to try on each file, keeping the order of common_blocks
+        file_blocks = defaultdict(list)
         for block_id, blocks in self.common_blocks.items():
             include_path = include_files[block_id]
             relative_include_path = os.path.relpath(include_path, self.directory)
@@ -316,348 +323,724 @@ class PHPRefactor:
             # Get the block type (first block in the list)
             block_type = blocks[0]['type']
             
+            for block in blocks:
+                file_blocks[block['file']].append((block_id, block_type, block['content'], include_statement))
+        
+        # Every file is rewritten independently, so the CPU-bound matching is spread
+        # over worker processes; their messages are printed here, in file order
+        jobs = [(file_path, self.file_contents[file_path], blocks, self.debug)
+                for file_path, blocks in file_blocks.items()]
+        for job, (new_content, file_replacements, messages) in zip(jobs, map_files(apply_blocks_to_file, jobs)):
+            file_path = job[0]
+            for message in messages:
+                print(message)
+            replacements += file_replacements
+            
+            # file_contents still holds what was read from disk, so files that end up
+            # byte-identical (e.g. a block replaced by its own include statement) are not written
+            if new_content != self.file_contents[file_path]:
+                self.file_contents[file_path] = new_content
+                self._dirty_files.add(file_path)
+        
+        self._flush_files()
+        print("Made {} replacements".format(replacements))
+        return replacements
+    
+    def run(self):
+        """
+        Run the complete refactoring process.
+        
+        Returns:
+            tuple: (number of files processed, number of common blocks, number of replacements)
+        """
+        self.scan_directory()
+        self.identify_common_blocks()
+        include_files = self.create_includes()
+        replacements = self.apply_includes(include_files)
+        
+        return len(self.php_files), len(self.common_blocks), replacements
+
+
+class FileRewriter:
+    """
+    Applies common blocks to a single PHP file, entirely in memory. It only holds the
+    state of its own file, so files can be rewritten in separate worker processes.
+    """
+    def __init__(self, file_path, content, debug=False):
+        """
+        Args:
+            file_path (str): Path of the PHP file
+            content (str): Current content of the file
+            debug (bool): Enable detailed debugging output
+        """
+        self.file_path = file_path
+        # Used in every message about the file
+        self.file_name = os.path.basename(file_path)
+        self.content = content
+        self.debug = debug
+        self.replacements = 0
+        self.messages = []
+        # Small navigation components get special treatment, decided once per file
+        self.is_navigation_file = 'navigation' in self.file_name.lower()
+        self._masked_cache = None
+        self._soup_cache = None
+        self._tree_cache = None
+        self._normalized_cache = None
+        self._fingerprint_cache = {}
+    
+    def _log(self, message):
+        """
+        Record a message; workers cannot print in order, so the caller prints them.
+        """
+        self.messages.append(message)
+    
+    def _masked(self):
+        """
+        Return the file as UTF-8 bytes with its PHP code masked, and the masked code regions,
+        computing them only once until the content changes.
+        """
+        if self._masked_cache is None:
+            self._masked_cache = mask_server_code(self.content.encode('utf-8'))
+        return self._masked_cache
+    
+    def _unmask(self, markup):
+        """
+        Put the file's PHP code back in markup taken from its soup or lxml tree.
+        """
+        return _unmask(markup, self._masked()[1])
+    
+    def _soup(self):
+        """
+        Return the parsed tree of the file, parsing it only once until the content changes.
+        """
+        if self._soup_cache is None:
+            self._soup_cache = BeautifulSoup(self._masked()[0].decode('utf-8'), _SOUP_PARSER)
+        return self._soup_cache
+    
+    def _tree(self):
+        """
+        Return the root of the file parsed by lxml, for XPath queries, parsing it only
+        once until the content changes.
+        """
+        if self._tree_cache is None:
+            # lxml refuses str input with an encoding declaration (<?xml ... encoding=...?>),
+            # so the content is parsed as UTF-8 bytes
+            self._tree_cache = etree.fromstring(self._masked()[0], HTML_PARSER)
+        return self._tree_cache
+    
+    def _normalized(self):
+        """
+        Return the whitespace-normalized content of the file and its offset map,
+        computing them only once until the content changes.
+        """
+        if self._normalized_cache is None:
+            self._normalized_cache = normalize_whitespace(self.content)
+        return self._normalized_cache
+    
+    def _fingerprints(self, tag_name):
+        """
+        Return the (element, fingerprint) pairs of every tag_name element of the file,
+        computing them only once per tag until the content changes.
+        """
+        if tag_name not in self._fingerprint_cache:
+            self._fingerprint_cache[tag_name] = [(element, element_fingerprint(element))
+                                                 for element in self._soup().find_all(tag_name)]
+        return self._fingerprint_cache[tag_name]
+    
+    def _source_span(self, element):
+        """
+        Locate an element of the lxml tree in the raw content. The parser does not
+        reserialize markup byte for byte (quoting, void tags...), so the serialized element
+        is often not found in the file. The element's start tag is the n-th start tag of that name
+        in the source, and its end is the close tag that brings the nesting back to zero.
+        Tags are counted in the masked content, so markup written by PHP code is left out.
+        
+        Returns:
+            tuple: (start, end) offsets in the content, or None if the source does not line up
+        """
+        masked = self._masked()[0].decode('utf-8')
+        same_name = list(self._tree().iter(element.tag))
+        index = same_name.index(element)
+        tags = list(tag_regex(element.tag).finditer(masked))
+        starts = [i for i, tag in enumerate(tags) if not tag.group(1)]
+        if len(starts) != len(same_name):
+            return None
+        
+        depth = 0
+        for tag in tags[starts[index]:]:
+            if tag.group(1):
+                depth -= 1
+            elif not tag.group(0).endswith('/>'):
+                depth += 1
+            if depth == 0:
+                # Placeholders never straddle a tag boundary, so the masked offsets map back
+                # through the length of the unmasked markup before and inside the span
+                start = len(self._unmask(masked[:tags[starts[index]].start()]))
+                return start, start + len(self._unmask(masked[tags[starts[index]].start():tag.end()]))
+        return None
+    
+    def _update(self, new_content):
+        """
+        Replace the content of the file and drop everything derived from the old content.
+        """
+        self.content = new_content
+        self._masked_cache = None
+        self._soup_cache = None
+        self._tree_cache = None
+        self._normalized_cache = None
+        self._fingerprint_cache = {}
+    
+    def apply_block(self, block_id, block_type, block_content, include_statement):
+        """
+        Replace one occurrence of a common block with its include statement.
+        
+        Args:
+            block_id (str): ID of the common block
+            block_type (str): Type of the common block
+            block_content (str): Content of the block as found in this file
+            include_statement (str): PHP include statement replacing the block
+            
+        Returns:
+            bool: True if the block was replaced
+        """
+        file_name = self.file_name
+        original_content = self.content
+        meta = block_meta(block_content)
+        
+        if self.debug:
+            self._log("Attempting to replace {} ({}) in: {}".format(block_id, block_type, file_name))
+        
+        # Track if we've made a replacement for this block
+        replacement_made = False
+        
+        # APPROACH 1: Direct string replacement (most reliable for exact matches).
+        # replace() hands back the unchanged string when the block is absent, so a
+        # single scan of the file both looks for the block and replaces it.
+        new_content = original_content.replace(block_content, include_statement)
+        if new_content != original_content:
+            self._update(new_content)
+            self.replacements += 1
+            replacement_made = True
+            self._log("Replaced block in {} (exact match)".format(file_name))
+        elif self.debug:
+            self._log("  - Exact match failed")
+        
+        # APPROACH 2: HTML structure-based replacement for specific block types
+        if not replacement_made and block_type in ['css_links', 'link_group', 'navigation', 'header', 'footer']:
             if self.debug:
-                print("\n----- Processing block {} ({}) -----".format(block_id, block_type))
+                self._log("  - Trying structure-based replacement")
             
-            # Process each file that contains this block
-            for block in blocks:
-                file_path = block['file']
-                original_content = self.file_contents[file_path]
-                
-                if self.debug:
-                    print("Attempting to replace in: {}".format(os.path.basename(file_path)))
-                
-                # Track if we've made a replacement for this block
-                replacement_made = False
-                
-                # APPROACH 1: Direct string replacement (most reliable for exact matches)
-                if block['content'] in original_content:
-                    new_content = original_content.replace(block['content'], include_statement)
-                    if new_content != original_content:
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            f.write(new_content)
-                        self.file_contents[file_path] = new_content
-                        replacements += 1
+            # For CSS links and similar structured content
+            if block_type in ['css_links', 'link_group']:
+                # Extract all link tags from the block and create a fingerprint
+                link_tags = meta.link_tags
+                if link_tags:
+                    # Create a pattern that matches these links with flexible whitespace
+                    pattern = '\\s*'.join([re.escape(tag) for tag in link_tags])
+                    matches = list(re.finditer(pattern, original_content, re.DOTALL))
+                    
+                    if matches:
+                        # Replace the first match
+                        match = matches[0]
+                        new_content = original_content[:match.start()] + include_statement + original_content[match.end():]
+                        self._update(new_content)
+                        self.replacements += 1
                         replacement_made = True
-                        print("Replaced block in {} (exact match)".format(os.path.basename(file_path)))
-                elif self.debug:
-                    print("  - Exact match failed")
-                
-                # APPROACH 2: HTML structure-based replacement for specific block types
-                if not replacement_made and block_type in ['css_links', 'link_group', 'navigation', 'header', 'footer']:
-                    if self.debug:
-                        print("  - Trying structure-based replacement")
+                        self._log("Replaced block in {} (link pattern match)".format(file_name))
+                    elif self.debug:
+                        self._log("  - Link pattern match failed. Found {} link tags".format(len(link_tags)))
+            
+            # For navigation, header, footer blocks
+            elif block_type in ['navigation', 'header', 'footer']:
+                # Extract key elements that uniquely identify this block
+                try:
+                    root = meta.root
                     
-                    # For CSS links and similar structured content
-                    if block_type in ['css_links', 'link_group']:
-                        # Extract all link tags from the block and create a fingerprint
-                        link_tags = re.findall(r'<link[^>]+>', block['content'])
-                        if link_tags:
-                            # Create a pattern that matches these links with flexible whitespace
-                            pattern = '\\s*'.join([re.escape(tag) for tag in link_tags])
-                            matches = list(re.finditer(pattern, original_content, re.DOTALL))
-                            
-                            if matches:
-                                # Replace the first match
-                                match = matches[0]
-                                new_content = original_content[:match.start()] + include_statement + original_content[match.end():]
-                                with open(file_path, 'w', encoding='utf-8') as f:
-                                    f.write(new_content)
-                                self.file_contents[file_path] = new_content
-                                replacements += 1
-                                replacement_made = True
-                                print("Replaced block in {} (link pattern match)".format(os.path.basename(file_path)))
-                            elif self.debug:
-                                print("  - Link pattern match failed. Found {} link tags".format(len(link_tags)))
+                    # Find all links, classes, and IDs to create a fingerprint
+                    fingerprint = meta.fingerprint
                     
-                    # For navigation, header, footer blocks
-                    elif block_type in ['navigation', 'header', 'footer']:
-                        # Extract key elements that uniquely identify this block
-                        try:
-                            soup = BeautifulSoup(block['content'], 'html.parser')
-                            
-                            # Find all links, classes, and IDs to create a fingerprint
-                            links = [a.get('href', '') for a in soup.find_all('a')]
-                            classes = [elem.get('class', []) for elem in soup.find_all(class_=True)]
-                            ids = [elem.get('id', '') for elem in soup.find_all(id=True)]
-                            
-                            # Create a fingerprint from these elements
-                            fingerprint = '|'.join(sorted(links + [c for cls in classes for c in cls] + ids))
-                            
-                            if self.debug:
-                                print("  - Block fingerprint: {}...".format(fingerprint[:50]))
-                            
-                            # Now try to find a matching block in the file
-                            file_soup = BeautifulSoup(original_content, 'html.parser')
-                            potential_matches = file_soup.find_all(soup.name) if soup.name else []
-                            
-                            if self.debug:
-                                print("  - Found {} potential matches with tag '{}'".format(len(potential_matches), soup.name))
-                            
-                            best_match = None
-                            best_similarity = 0
-                            
-                            for potential_match in potential_matches:
-                                # Create fingerprint for this potential match
-                                p_links = [a.get('href', '') for a in potential_match.find_all('a')]
-                                p_classes = [elem.get('class', []) for elem in potential_match.find_all(class_=True)]
-                                p_ids = [elem.get('id', '') for elem in potential_match.find_all(id=True)]
-                                p_fingerprint = '|'.join(sorted(p_links + [c for cls in p_classes for c in cls] + p_ids))
-                                
-                                # Calculate similarity
-                                similarity = difflib.SequenceMatcher(None, fingerprint, p_fingerprint).ratio()
-                                
-                                if similarity > best_similarity:
-                                    best_similarity = similarity
-                                    best_match = potential_match
-                            
-                            if self.debug and best_match:
-                                print("  - Best match similarity: {:.2f}".format(best_similarity))
-                            
-                            if best_match and best_similarity >= 0.8:  # High similarity threshold
-                                # Found a match, replace it
-                                match_str = str(best_match)
-                                if match_str in original_content:
-                                    new_content = original_content.replace(match_str, include_statement)
-                                    with open(file_path, 'w', encoding='utf-8') as f:
-                                        f.write(new_content)
-                                    self.file_contents[file_path] = new_content
-                                    replacements += 1
-                                    replacement_made = True
-                                    print("Replaced block in {} (structural match, similarity: {:.2f})".format(os.path.basename(file_path), best_similarity))
-                        except Exception as e:
-                            if self.debug:
-                                print("  - Error in structural matching: {}".format(e))
-                
-                # APPROACH 3: DOM-based replacement for more complex structures
-                if not replacement_made and block_type in ['script', 'meta_tags', 'php_code']:
                     if self.debug:
-                        print("  - Trying DOM-based replacement")
+                        self._log("  - Block fingerprint: {}...".format('|'.join(sorted(value for _, value in fingerprint))[:50]))
                     
-                    # For script tags
-                    if block_type == 'script':
-                        # Extract script content and attributes
-                        try:
-                            script_soup = BeautifulSoup(block['content'], 'html.parser')
-                            script_tag = script_soup.find('script')
-                            
-                            if script_tag:
-                                script_attrs = {k: v for k, v in script_tag.attrs.items()}
-                                
-                                # Find matching scripts in the file
-                                file_soup = BeautifulSoup(original_content, 'html.parser')
-                                for potential_script in file_soup.find_all('script'):
-                                    # Check if attributes match
-                                    attrs_match = True
-                                    for k, v in script_attrs.items():
-                                        if potential_script.get(k) != v:
-                                            attrs_match = False
-                                            break
-                                    
-                                    if attrs_match:
-                                        # Found a match, replace it
-                                        match_str = str(potential_script)
-                                        if match_str in original_content:
-                                            new_content = original_content.replace(match_str, include_statement)
-                                            with open(file_path, 'w', encoding='utf-8') as f:
-                                                f.write(new_content)
-                                            self.file_contents[file_path] = new_content
-                                            replacements += 1
-                                            replacement_made = True
-                                            print("Replaced block in {} (script match)".format(os.path.basename(file_path)))
-                                            break
-                        except Exception as e:
-                            if self.debug:
-                                print("  - Error in script matching: {}".format(e))
+                    # Now try to find a matching block in the file
+                    potential_matches = self._fingerprints(root.name) if root is not None else []
                     
-                    # For meta tags
-                    elif block_type == 'meta_tags':
-                        # Similar approach as with script tags, but for meta tags
-                        try:
-                            meta_soup = BeautifulSoup(block['content'], 'html.parser')
-                            meta_tags = meta_soup.find_all('meta')
-                            
-                            if meta_tags:
-                                # Create a pattern that matches these meta tags with flexible whitespace
-                                pattern = '\\s*'.join([re.escape(str(tag)) for tag in meta_tags])
-                                matches = list(re.finditer(pattern, original_content, re.DOTALL))
-                                
-                                if matches:
-                                    # Replace the first match
-                                    match = matches[0]
-                                    new_content = original_content[:match.start()] + include_statement + original_content[match.end():]
-                                    with open(file_path, 'w', encoding='utf-8') as f:
-                                        f.write(new_content)
-                                    self.file_contents[file_path] = new_content
-                                    replacements += 1
-                                    replacement_made = True
-                                    print("Replaced block in {} (meta tags match)".format(os.path.basename(file_path)))
-                        except Exception as e:
-                            if self.debug:
-                                print("  - Error in meta tags matching: {}".format(e))
-                
-                # APPROACH 4: Fuzzy matching as a last resort
-                if not replacement_made:
+                    if self.debug and root is not None:
+                        self._log("  - Found {} potential matches with tag '{}'".format(len(potential_matches), root.name))
+                    
+                    best_match = None
+                    best_similarity = 0
+                    
+                    for potential_match, p_fingerprint in potential_matches:
+                        # Calculate similarity (Jaccard index of the two fingerprints)
+                        common = len(fingerprint & p_fingerprint)
+                        if not common:
+                            continue
+                        similarity = common / len(fingerprint | p_fingerprint)
+                        
+                        if similarity > best_similarity:
+                            best_similarity = similarity
+                            best_match = potential_match
+                    
+                    if self.debug and best_match:
+                        self._log("  - Best match similarity: {:.2f}".format(best_similarity))
+                    
+                    if best_match and best_similarity >= 0.8:  # High similarity threshold
+                        # Found a match, replace it
+                        match_str = self._unmask(str(best_match))
+                        idx = original_content.find(match_str)
+                        if idx != -1:
+                            new_content = original_content[:idx] + include_statement + original_content[idx + len(match_str):]
+                            self._update(new_content)
+                            self.replacements += 1
+                            replacement_made = True
+                            self._log("Replaced block in {} (structural match, similarity: {:.2f})".format(file_name, best_similarity))
+                except Exception as e:
                     if self.debug:
-                        print("  - Trying fuzzy matching")
+                        self._log("  - Error in structural matching: {}".format(e))
+        
+        # APPROACH 3: DOM-based replacement for more complex structures
+        if not replacement_made and block_type in ['script', 'meta_tags', 'php_code']:
+            if self.debug:
+                self._log("  - Trying DOM-based replacement")
+            
+            # For script tags
+            if block_type == 'script':
+                # Extract script content and attributes
+                try:
+                    script_soup = meta.soup
+                    script_tag = script_soup.find('script')
                     
-                    # Normalize whitespace in both content and block
-                    try:
-                        normalized_content = re.sub(r'\s+', ' ', original_content)
-                        normalized_block = re.sub(r'\s+', ' ', block['content'])
+                    if script_tag:
+                        script_attrs = {k: v for k, v in script_tag.attrs.items()}
                         
-                        # Try to find the block with normalized whitespace
-                        if normalized_block in normalized_content:
-                            if self.debug:
-                                print("  - Found normalized match")
+                        # Find matching scripts in the file
+                        file_soup = self._soup()
+                        for potential_script in file_soup.find_all('script'):
+                            # Check if attributes match
+                            attrs_match = True
+                            for k, v in script_attrs.items():
+                                if potential_script.get(k) != v:
+                                    attrs_match = False
+                                    break
                             
-                            # Special case for navigation files - if the file itself is a navigation file,
-                            # and it's small enough, just replace the entire content
-                            if block_type == 'navigation' and 'navigation' in os.path.basename(file_path).lower():
-                                if len(original_content) < len(block['content']) * 1.5:  # File is not much larger than block
-                                    new_content = include_statement
-                                    with open(file_path, 'w', encoding='utf-8') as f:
-                                        f.write(new_content)
-                                    self.file_contents[file_path] = new_content
-                                    replacements += 1
+                            if attrs_match:
+                                # Found a match, replace it
+                                match_str = self._unmask(str(potential_script))
+                                idx = original_content.find(match_str)
+                                if idx != -1:
+                                    new_content = original_content[:idx] + include_statement + original_content[idx + len(match_str):]
+                                    self._update(new_content)
+                                    self.replacements += 1
                                     replacement_made = True
-                                    print("Replaced block in {} (navigation file replacement)".format(os.path.basename(file_path)))
-                            
-                            # If not a special case or special case didn't work, try normal fuzzy matching
-                            if not replacement_made:
-                                # Find all occurrences of the normalized block
-                                start_pos = 0
-                                while True:
-                                    pos = normalized_content.find(normalized_block, start_pos)
-                                    if pos == -1:
-                                        break
-                                    
-                                    # Calculate the approximate position in the original content
-                                    content_before = normalized_content[:pos]
-                                    original_start = len(re.sub(r'\s+', ' ', original_content[:len(content_before) + 20]).rstrip())
-                                    
-                                    # Try to find the exact block in the original content around this position
-                                    found = False
-                                    for i in range(max(0, original_start - 100), min(len(original_content), original_start + 100)):
-                                        # Try different lengths to account for whitespace differences
-                                        for length in range(len(block['content']), len(block['content']) + 100):
-                                            if i + length <= len(original_content):
-                                                candidate = original_content[i:i+length]
-                                                # Compare normalized versions
-                                                if re.sub(r'\s+', ' ', candidate) == normalized_block:
-                                                    # Found a match with normalized whitespace
-                                                    new_content = original_content[:i] + include_statement + original_content[i+length:]
-                                                    with open(file_path, 'w', encoding='utf-8') as f:
-                                                        f.write(new_content)
-                                                    self.file_contents[file_path] = new_content
-                                                    replacements += 1
-                                                    replacement_made = True
-                                                    print("Replaced block in {} (fuzzy match)".format(os.path.basename(file_path)))
-                                                    found = True
-                                                    break
-                                        if found:
-                                            break
-                                    
-                                    start_pos = pos + len(normalized_block)
-                                    if found:
-                                        break
-                    except Exception as e:
-                        if self.debug:
-                            print("  - Error in fuzzy matching: {}".format(e))
-                
-                # APPROACH 5: Content-based matching for navigation blocks
-                if not replacement_made and block_type in ['navigation']:
+                                    self._log("Replaced block in {} (script match)".format(file_name))
+                                    break
+                except Exception as e:
                     if self.debug:
-                        print("  - Trying content-based navigation matching")
+                        self._log("  - Error in script matching: {}".format(e))
+            
+            # For meta tags
+            elif block_type == 'meta_tags':
+                # Similar approach as with script tags, but for meta tags
+                try:
+                    meta_soup = meta.soup
+                    meta_tags = meta_soup.find_all('meta')
                     
-                    try:
-                        # Extract all menu items from the block
-                        soup = BeautifulSoup(block['content'], 'html.parser')
-                        menu_items = []
-                        for a in soup.find_all('a'):
-                            menu_items.append((a.get('href', ''), a.get_text().strip()))
+                    if meta_tags:
+                        # Create a pattern that matches these meta tags with flexible whitespace
+                        pattern = '\\s*'.join([re.escape(meta.unmask(str(tag))) for tag in meta_tags])
+                        matches = list(re.finditer(pattern, original_content, re.DOTALL))
                         
-                        if menu_items and len(menu_items) >= 3:  # At least 3 menu items to be confident
-                            if self.debug:
-                                print("  - Found {} menu items in block".format(len(menu_items)))
-                            
-                            # Create a pattern to find these menu items in sequence
-                            file_soup = BeautifulSoup(original_content, 'html.parser')
-                            
-                            # Find potential navigation containers
-                            potential_navs = file_soup.find_all(['nav', 'div', 'ul'], class_=re.compile(r'(nav|menu)', re.I))
-                            if not potential_navs:  # If no nav with class, try any nav or ul
-                                potential_navs = file_soup.find_all(['nav', 'ul'])
-                            
-                            if self.debug:
-                                print("  - Found {} potential navigation containers".format(len(potential_navs)))
-                            
-                            for nav in potential_navs:
-                                nav_links = [(a.get('href', ''), a.get_text().strip()) for a in nav.find_all('a')]
-                                
-                                # Calculate how many menu items match
-                                matches = sum(1 for item in menu_items if item in nav_links)
-                                match_ratio = matches / len(menu_items) if menu_items else 0
-                                
-                                if self.debug:
-                                    print("  - Nav container has {} links, match ratio: {:.2f}".format(len(nav_links), match_ratio))
-                                
-                                if match_ratio >= 0.7:  # At least 70% of menu items match
-                                    # Found a match, replace it
-                                    match_str = str(nav)
-                                    if match_str in original_content:
-                                        new_content = original_content.replace(match_str, include_statement)
-                                        with open(file_path, 'w', encoding='utf-8') as f:
-                                            f.write(new_content)
-                                        self.file_contents[file_path] = new_content
-                                        replacements += 1
-                                        replacement_made = True
-                                        print("Replaced block in {} (menu content match, ratio: {:.2f})".format(os.path.basename(file_path), match_ratio))
-                                        break
-                    except Exception as e:
-                        if self.debug:
-                            print("  - Error in content-based navigation matching: {}".format(e))
+                        if matches:
+                            # Replace the first match
+                            match = matches[0]
+                            new_content = original_content[:match.start()] + include_statement + original_content[match.end():]
+                            self._update(new_content)
+                            self.replacements += 1
+                            replacement_made = True
+                            self._log("Replaced block in {} (meta tags match)".format(file_name))
+                except Exception as e:
+                    if self.debug:
+                        self._log("  - Error in meta tags matching: {}".format(e))
+        
+        # APPROACH 4: Fuzzy matching as a last resort
+        if not replacement_made:
+            if self.debug:
+                self._log("  - Trying fuzzy matching")
+            
+            # Normalize whitespace in both content and block
+            try:
+                normalized_content, offsets = self._normalized()
+                normalized_block = meta.normalized_content
+                pos = normalized_content.find(normalized_block)
                 
-                # APPROACH 6: Special case for navigation files
-                if not replacement_made and block_type == 'navigation' and 'navigation' in os.path.basename(file_path).lower():
+                # Try to find the block with normalized whitespace
+                if pos != -1:
                     if self.debug:
-                        print("  - Trying special navigation file replacement")
+                        self._log("  - Found normalized match")
                     
-                    # If this is a navigation file (based on filename) and we've tried everything else,
-                    # just replace the entire content as a last resort
-                    try:
-                        # Only do this if the file is small and likely to be just a navigation component
-                        if len(original_content) < 5000:  # Arbitrary size limit to avoid replacing large files
+                    # Special case for navigation files - if the file itself is a navigation file,
+                    # and it's small enough, just replace the entire content
+                    if block_type == 'navigation' and self.is_navigation_file:
+                        if len(original_content) < len(block_content) * 1.5:  # File is not much larger than block
                             new_content = include_statement
-                            with open(file_path, 'w', encoding='utf-8') as f:
-                                f.write(new_content)
-                            self.file_contents[file_path] = new_content
-                            replacements += 1
+                            self._update(new_content)
+                            self.replacements += 1
                             replacement_made = True
-                            print("Replaced block in {} (navigation file fallback)".format(os.path.basename(file_path)))
-                    except Exception as e:
-                        if self.debug:
-                            print("  - Error in navigation file fallback: {}".format(e))
+                            self._log("Replaced block in {} (navigation file replacement)".format(file_name))
+                    
+                    # If not a special case or special case didn't work, map the normalized
+                    # match back to its exact range in the original content
+                    if not replacement_made:
+                        start = offsets[pos]
+                        end = offsets[pos + len(normalized_block)]
+                        new_content = original_content[:start] + include_statement + original_content[end:]
+                        self._update(new_content)
+                        self.replacements += 1
+                        replacement_made = True
+                        self._log("Replaced block in {} (fuzzy match)".format(file_name))
+            except Exception as e:
+                if self.debug:
+                    self._log("  - Error in fuzzy matching: {}".format(e))
+        
+        # APPROACH 5: Content-based matching for navigation blocks
+        if not replacement_made and block_type in ['navigation']:
+            if self.debug:
+                self._log("  - Trying content-based navigation matching")
+            
+            try:
+                # Extract all menu items from the block
+                menu_items = meta.menu_items
                 
-                if not replacement_made:
-                    print("Warning: Could not find block in {}".format(os.path.basename(file_path)))
+                if menu_items and len(menu_items) >= 3:  # At least 3 menu items to be confident
+                    if self.debug:
+                        self._log("  - Found {} menu items in block".format(len(menu_items)))
+                    
+                    # Find potential navigation containers
+                    root = self._tree()
+                    potential_navs = _MENU_CONTAINERS_XPATH(root) if root is not None else []
+                    if not potential_navs and root is not None:  # If no nav with class, try any nav or ul
+                        potential_navs = _NAV_OR_LIST_XPATH(root)
+                    
+                    if self.debug:
+                        self._log("  - Found {} potential navigation containers".format(len(potential_navs)))
+                    
+                    menu_items_set = meta.menu_items_set
+                    
+                    # A container with fewer distinct links than 70% of the menu items cannot
+                    # reach the ratio, so it is dropped before matching. The others are tried
+                    # in document order: the first matching container is the one replaced.
+                    candidates = []
+                    for nav in potential_navs:
+                        nav_links = frozenset((a.get('href', ''), ''.join(a.itertext()).strip()) for a in nav.iter('a'))
+                        if len(nav_links) / len(menu_items_set) >= 0.7:
+                            candidates.append((nav, nav_links))
+                    
+                    for nav, nav_links in candidates:
+                        # Calculate how many menu items match
+                        match_ratio = len(menu_items_set & nav_links) / len(menu_items_set)
+                        
+                        if self.debug:
+                            self._log("  - Nav container has {} links, match ratio: {:.2f}".format(len(nav_links), match_ratio))
+                        
+                        if match_ratio >= 0.7:  # At least 70% of menu items match
+                            # Found a match, replace the container where it sits in the source.
+                            # If it cannot be located, fall back to its serialized form.
+                            span = self._source_span(nav)
+                            if not span:
+                                match_str = self._unmask(etree.tostring(nav, method='html', encoding='unicode', with_tail=False))
+                                idx = original_content.find(match_str)
+                                span = (idx, idx + len(match_str)) if idx != -1 else None
+                            if span:
+                                new_content = original_content[:span[0]] + include_statement + original_content[span[1]:]
+                                self._update(new_content)
+                                self.replacements += 1
+                                replacement_made = True
+                                self._log("Replaced block in {} (menu content match, ratio: {:.2f})".format(file_name, match_ratio))
+                                break
+            except Exception as e:
+                if self.debug:
+                    self._log("  - Error in content-based navigation matching: {}".format(e))
         
-        print("Made {} replacements".format(replacements))
-        return replacements
+        # APPROACH 6: Special case for navigation files
+        if not replacement_made and block_type == 'navigation' and self.is_navigation_file:
+            if self.debug:
+                self._log("  - Trying special navigation file replacement")
+            
+            # If this is a navigation file (based on filename) and we've tried everything else,
+            # just replace the entire content as a last resort
+            try:
+                # Only do this if the file is small and likely to be just a navigation component
+                if len(original_content) < 5000:  # Arbitrary size limit to avoid replacing large files
+                    new_content = include_statement
+                    self._update(new_content)
+                    self.replacements += 1
+                    replacement_made = True
+                    self._log("Replaced block in {} (navigation file fallback)".format(file_name))
+            except Exception as e:
+                if self.debug:
+                    self._log("  - Error in navigation file fallback: {}".format(e))
+        
+        if not replacement_made:
+            self._log("Warning: Could not find block in {}".format(file_name))
+        return replacement_made
+
+
+def _masked_soup(content, **kwargs):
+    """
+    Parse markup with BeautifulSoup, with its PHP code masked (see mask_server_code).
     
-    def run(self):
-        """
-        Run the complete refactoring process.
+    Args:
+        content (str): Markup to parse
+        **kwargs: Passed on to BeautifulSoup (e.g. parse_only)
         
-        Returns:
-            tuple: (number of files processed, number of common blocks, number of replacements)
-        """
-        self.scan_directory()
-        self.identify_common_blocks()
-        include_files = self.create_includes()
-        replacements = self.apply_includes(include_files)
+    Returns:
+        tuple: (BeautifulSoup object, masked code regions to pass to _unmask)
+    """
+    masked, server_code = mask_server_code(content.encode('utf-8'))
+    return BeautifulSoup(masked.decode('utf-8'), _SOUP_PARSER, **kwargs), server_code
+
+
+def _unmask(markup, server_code):
+    """
+    Put masked PHP code back in markup serialized from a masked tree.
+    
+    Args:
+        markup (str): Serialized markup
+        server_code (dict): Code regions returned by mask_server_code
         
-        return len(self.php_files), len(self.common_blocks), replacements
+    Returns:
+        str: The markup with its original PHP code
+    """
+    if not server_code:
+        return markup
+    return unmask_server_code(markup.encode('utf-8'), server_code).decode('utf-8')
+
+
+@lru_cache(maxsize=256)
+def block_meta(content):
+    """
+    Return the BlockMeta of a block's content, shared by all files rewritten in this process.
+    
+    Args:
+        content (str): Block content
+        
+    Returns:
+        BlockMeta: Lazily derived data of the block
+    """
+    return BlockMeta(content)
+
+
+@lru_cache(maxsize=None)
+def tag_regex(tag_name):
+    """
+    Return the compiled regex matching the start and end tags of an element name.
+    
+    Args:
+        tag_name (str): Element name
+        
+    Returns:
+        re.Pattern: Pattern whose group 1 is '/' for end tags and empty for start tags
+    """
+    return re.compile(r'<(/?){}(?=[\s/>])[^>]*>'.format(re.escape(tag_name)), re.I)
+
+
+def apply_blocks_to_file(job):
+    """
+    Apply common blocks to one PHP file. Runs in worker processes.
+    
+    Args:
+        job (tuple): (file_path, content, blocks, debug), where blocks is a list of
+                     (block_id, block_type, block_content, include_statement) tuples
+        
+    Returns:
+        tuple: (new content, number of replacements, messages to print)
+    """
+    file_path, content, blocks, debug = job
+    rewriter = FileRewriter(file_path, content, debug)
+    for block in blocks:
+        rewriter.apply_block(*block)
+    return rewriter.content, rewriter.replacements, rewriter.messages
+
+
+def extract_potential_blocks(content, min_block_size):
+    """
+    Extract potential blocks from a PHP file using BeautifulSoup.
+    This extracts HTML blocks, script tags, and other common elements.
+    
+    Runs in worker processes, so it only takes and returns picklable values.
+    
+    Args:
+        content (str): PHP file content
+        min_block_size (int): Minimum size in characters for a block to be considered
+        
+    Returns:
+        tuple: (list of potential blocks with their type and content, list of messages to print)
+    """
+    blocks = []
+    messages = []
+    
+    # Try to parse the content with BeautifulSoup
+    try:
+        # PHP code is masked while parsing, then put back in the markup of each block, so
+        # blocks keep it exactly as written (even inside attribute values, which would be escaped)
+        soup, server_code = _masked_soup(content, parse_only=_BLOCK_STRAINER)
+        
+        def markup(element):
+            return _unmask(str(element), server_code)
+        
+        # Extract script tags (each tag is serialized only once)
+        for script in soup.find_all('script'):
+            script_html = markup(script)
+            if len(script_html) >= min_block_size:
+                blocks.append({
+                    'type': 'script',
+                    'content': script_html
+                })
+        
+        # Extract navigation menus (common patterns)
+        for nav in soup.find_all(['nav', 'div'], class_=_NAV_CLASS_RE):
+            nav_html = markup(nav)
+            if len(nav_html) >= min_block_size:
+                blocks.append({
+                    'type': 'navigation',
+                    'content': nav_html
+                })
+                
+        # Extract headers
+        header = soup.find('header')
+        if header:
+            header_html = markup(header)
+            if len(header_html) >= min_block_size:
+                blocks.append({
+                    'type': 'header',
+                    'content': header_html
+                })
+            
+        # Extract footers
+        footer = soup.find('footer')
+        if footer:
+            footer_html = markup(footer)
+            if len(footer_html) >= min_block_size:
+                blocks.append({
+                    'type': 'footer',
+                    'content': footer_html
+                })
+        
+        # Extract head content - specifically targeting CSS and favicon links
+        head = soup.find('head')
+        if head:
+            # Find all link tags in the head
+            link_tags = head.find_all('link')
+            
+            # Look for CSS and favicon links specifically
+            css_favicon_links = []
+            for link in link_tags:
+                if 'rel' in link.attrs and link['rel'] == 'stylesheet' or \
+                   'type' in link.attrs and link['type'] == 'image/x-icon' or \
+                   'href' in link.attrs and ('.css' in link['href'] or 'favicon' in link['href']):
+                    css_favicon_links.append(link)
+            
+            # If we have consecutive CSS/favicon links, group them
+            if len(css_favicon_links) >= 2:
+                # Find consecutive sequences
+                i = 0
+                while i < len(css_favicon_links):
+                    # Start a new group
+                    group = [css_favicon_links[i]]
+                    j = i + 1
+                    
+                    # Find consecutive siblings
+                    while j < len(css_favicon_links):
+                        # Check if they are adjacent in the original HTML
+                        if are_adjacent_siblings(css_favicon_links[j-1], css_favicon_links[j]):
+                            group.append(css_favicon_links[j])
+                            j += 1
+                        else:
+                            break
+                    
+                    # If we have a group of 2 or more, add it
+                    if len(group) >= 2:
+                        group_content = ''.join(markup(tag) for tag in group)
+                        if len(group_content) >= min_block_size:
+                            blocks.append({
+                                'type': 'css_links',
+                                'content': group_content
+                            })
+                    
+                    i = j
+            
+            # Also look for meta tags groups
+            meta_tags = head.find_all('meta')
+            if len(meta_tags) >= 2:
+                i = 0
+                while i < len(meta_tags):
+                    group = [meta_tags[i]]
+                    j = i + 1
+                    
+                    while j < len(meta_tags):
+                        if are_adjacent_siblings(meta_tags[j-1], meta_tags[j]):
+                            group.append(meta_tags[j])
+                            j += 1
+                        else:
+                            break
+                    
+                    if len(group) >= 2:
+                        group_content = ''.join(markup(tag) for tag in group)
+                        if len(group_content) >= min_block_size:
+                            blocks.append({
+                                'type': 'meta_tags',
+                                'content': group_content
+                            })
+                    
+                    i = j
+        
+        # Direct pattern matching for common blocks
+        # This is a more targeted approach for specific patterns like CSS links.
+        # The patterns run on the raw content so the matches appear verbatim in the file.
+        for match in _CSS_LINKS_RE.finditer(content):
+            match_content = match.group(0)
+            blocks.append({
+                'type': 'css_links',
+                'content': match_content
+            })
+        
+        # More general pattern for consecutive link tags
+        for match in _LINK_GROUP_RE.finditer(content):
+            match_content = match.group(0)
+            if len(match_content) >= min_block_size:
+                blocks.append({
+                    'type': 'link_group',
+                    'content': match_content
+                })
+            
+    except Exception as e:
+        messages.append(f"Error parsing file with BeautifulSoup: {e}")
+        
+    # Also try regex-based extraction for PHP blocks
+    php_blocks = _PHP_BLOCK_RE.findall(content)
+    for block in php_blocks:
+        if len(block) >= min_block_size:
+            blocks.append({
+                'type': 'php_code',
+                'content': f'<?php {block} ?>'
+            })
+            
+    return blocks, messages
+
+
+def read_file(file_path):
+    """
+    Read a PHP file as text, ignoring undecodable bytes.
+    
+    Args:
+        file_path (str): Path of the file
+        
+    Returns:
+        str: File content
+    """
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
 
 
 def are_adjacent_siblings(elem1, elem2):
@@ -671,13 +1054,73 @@ def are_adjacent_siblings(elem1, elem2):
     Returns:
         bool: True if they are adjacent siblings, False otherwise
     """
-    # Get the next sibling of elem1, skipping whitespace
-    next_sibling = elem1.next_sibling
-    while next_sibling and isinstance(next_sibling, str) and next_sibling.strip() == '':
-        next_sibling = next_sibling.next_sibling
+    # Check if the next non-whitespace sibling of elem1 is elem2 (by identity: Tag
+    # equality would compare both subtrees)
+    for sibling in elem1.next_siblings:
+        if isinstance(sibling, NavigableString) and not sibling.strip():
+            continue
+        return sibling is elem2
+    return False
+
+
+def element_fingerprint(element):
+    """
+    Identify a block by the links, classes and IDs it contains.
     
-    # Check if the next non-whitespace sibling is elem2
-    return next_sibling == elem2
+    Args:
+        element: BeautifulSoup element
+        
+    Returns:
+        frozenset: ('href' | 'class' | 'id', value) pairs found in the element
+    """
+    return frozenset(
+        [('href', a.get('href', '')) for a in element.find_all('a')] +
+        [('class', c) for elem in element.find_all(class_=True) for c in elem.get('class', [])] +
+        [('id', elem.get('id', '')) for elem in element.find_all(id=True)]
+    )
+
+
+def normalize_whitespace(text):
+    """
+    Collapse every run of whitespace into a single space.
+    
+    Args:
+        text (str): Text to normalize
+        
+    Returns:
+        tuple: (normalized text, list mapping each normalized position to its position in text,
+                with one extra entry for the end of the text)
+    """
+    parts = []
+    offsets = []
+    pos = 0
+    for match in _WS_RE.finditer(text):
+        parts.append(text[pos:match.start()])
+        offsets.extend(range(pos, match.start()))
+        parts.append(' ')
+        offsets.append(match.start())
+        pos = match.end()
+    parts.append(text[pos:])
+    offsets.extend(range(pos, len(text)))
+    offsets.append(len(text))
+    return ''.join(parts), offsets
+
+
+def minhash_bands(content):
+    """
+    Compute the LSH band keys of a block's MinHash signature.
+    
+    Args:
+        content (str): Block content
+        
+    Returns:
+        list: One hashable key per band; similar blocks are likely to share at least one
+    """
+    tokens = _TOKEN_RE.findall(content)
+    size = min(_SHINGLE_SIZE, len(tokens)) or 1
+    shingles = {zlib.crc32(' '.join(tokens[i:i+size]).encode()) for i in range(max(1, len(tokens) - size + 1))}
+    signature = [min((a * shingle + b) % _MINHASH_PRIME for shingle in shingles) for a, b in _MINHASH_PERMUTATIONS]
+    return [(band,) + tuple(signature[band*_LSH_ROWS:(band+1)*_LSH_ROWS]) for band in range(_LSH_BANDS)]
 
 
 def extract_php_includes(domain, download_path, min_block_size=50, similarity_threshold=0.9, min_occurrences=2, debug=False):
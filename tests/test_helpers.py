@@ -0,0 +1,130 @@
+import contextlib
+import io
+import os
+import random
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+import helpers
+
+DOMAIN = 'https://example.com'
+
+# A small mirror: pages referencing each other with relative, absolute and PHP-generated URLs,
+# files with a query string in their name, and include files that are only part of a page
+SITE = {
+    'index.html': (
+        '<!DOCTYPE html>\n'
+        '<html><head><title>Home</title><link href="style.css@v=1" rel="stylesheet"></head><body>\n'
+        '<a href="sub/page.html">Page</a> <a href="about.php.html">About</a>'
+        ' <a href="https://example.com/sub/page.html#top">Abs</a>\n'
+        '<a href="<?php echo $url; ?>">Dynamic</a> <?php if ($a > 1) { echo "<b>big</b>"; } ?>\n'
+        '</body></html>\n'),
+    'about.php.html': '<html><body><p>About</p><a href="index.html">Home</a></body></html>\n',
+    'sub/page.html': '<html><body><a href="../index.html">Up</a><img src="./img.png"></body></html>\n',
+    'style.css@v=1': 'body { color: red }\n',
+    'css/site.css': '@import url("../style.css@v=1");\n',
+    'inc/header.php': '<html><head><title>T</title></head><body>\n<div id="page"><a href="menu.html">Menu</a>\n',
+    'inc/footer.php': '</div>\n<footer><a href="../index.html">Home</a></footer>\n</body></html>\n',
+    'inc/nav.php': '<nav><a href="../sub/page.html">Page</a><?php echo $extra; ?></nav>\n',
+}
+
+
+def write_tree(root, files):
+    for name, text in files.items():
+        path = os.path.join(root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+def read_tree(root):
+    files = {}
+    for dir_path, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dir_path, name)
+            with open(path, encoding='utf-8') as f:
+                files[os.path.relpath(path, root).replace(os.sep, '/')] = f.read()
+    return files
+
+
+class ApplyTransformsTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.tmp = self._tmp.name
+
+    def site(self, name, files=SITE):
+        root = os.path.join(self.tmp, name)
+        write_tree(root, files)
+        return root
+
+    def test_single_pass_matches_separate_passes(self):
+        combined = self.site('combined')
+        separate = self.site('separate')
+        with contextlib.redirect_stdout(io.StringIO()):
+            helpers.apply_transforms(DOMAIN, combined, {"fix-query", "normalize-html", "php-rename", "pretty-print"})
+            helpers.fix_query_strings(DOMAIN, separate)
+            helpers.normalize_html(DOMAIN, separate)
+            helpers.php_rename(DOMAIN, separate)
+            helpers.pretty_print(DOMAIN, separate)
+        self.assertEqual(read_tree(combined), read_tree(separate))
+
+    def test_server_code_is_kept(self):
+        root = self.site('site')
+        with contextlib.redirect_stdout(io.StringIO()):
+            helpers.apply_transforms(DOMAIN, root, {"normalize-html", "pretty-print"})
+        files = read_tree(root)
+        self.assertIn('<a href="<?php echo $url; ?>">Dynamic</a>', files['index.html'])
+        self.assertIn('<?php if ($a > 1) { echo "<b>big</b>"; } ?>', files['index.html'])
+        self.assertIn('<?php echo $extra; ?>', files['inc/nav.php'])
+
+    def test_fragment_is_not_wrapped(self):
+        root = self.site('site')
+        with contextlib.redirect_stdout(io.StringIO()):
+            helpers.apply_transforms(DOMAIN, root, {"pretty-print"})
+        self.assertEqual(read_tree(root)['inc/nav.php'],
+                         '<nav>\n <a href="../sub/page.html">Page</a>\n <?php echo $extra; ?>\n</nav>\n')
+
+    def test_partial_pages_keep_their_tags(self):
+        root = self.site('site')
+        with contextlib.redirect_stdout(io.StringIO()):
+            helpers.apply_transforms(DOMAIN, root, {"normalize-html", "pretty-print"})
+        files = read_tree(root)
+        self.assertEqual(files['inc/footer.php'],
+                         '</div>\n<footer><a href="/index.html">Home</a></footer>\n</body></html>\n')
+        self.assertEqual(files['inc/header.php'],
+                         '<html><head><title>T</title></head><body>\n<div id="page"><a href="/inc/menu.html">Menu</a>\n')
+
+    def test_pretty_cache_is_kept_outside_the_site(self):
+        root = self.site('example.com/blog')
+        cache_dir = os.path.join(self.tmp, '.pretty_cache')
+        with contextlib.redirect_stdout(io.StringIO()):
+            helpers.pretty_print(DOMAIN + '/blog', root, cache_dir=cache_dir)
+        first = read_tree(self.tmp)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            helpers.pretty_print(DOMAIN + '/blog', root, cache_dir=cache_dir)
+        self.assertEqual(os.listdir(cache_dir), ['example.com_blog.json'])
+        self.assertEqual(read_tree(self.tmp), first)
+        self.assertIn('Processed 0 files, skipped', output.getvalue())
+
+
+class FixQueryStreamTest(unittest.TestCase):
+    def test_blocks_match_a_single_substitution(self):
+        rnd = random.Random(0)
+        for _ in range(500):
+            names = {bytes(rnd.choice(b'ab@') for _ in range(rnd.randint(1, 6))) for _ in range(rnd.randint(1, 4))}
+            query_refs = {name: bytes(rnd.choice(b'xyz') for _ in range(rnd.randint(0, 4))) for name in names}
+            query_refs_re = re.compile(b'|'.join(re.escape(name) for name in sorted(query_refs, key=len, reverse=True)))
+            ctx = {'query_refs_re': query_refs_re, 'query_refs': query_refs,
+                   'query_refs_len': max(map(len, query_refs))}
+            content = bytes(rnd.choice(b'ab@c') for _ in range(rnd.randint(0, 80)))
+            expected = query_refs_re.sub(lambda m: query_refs[m.group(0)], content)
+            with mock.patch.object(helpers, '_CHUNK_SIZE', rnd.randint(1, 9)):
+                self.assertEqual(b''.join(helpers._iter_query_fixed(io.BytesIO(content), ctx)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import contextlib
+import io
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import php_refactor
+from php_refactor import FileRewriter, PHPRefactor, extract_potential_blocks
+
+from tests.test_helpers import read_tree, write_tree
+
+WORDS = 'home about contact products services blog news team careers faq help shop'.split()
+
+
+def make_site(seed, pages=10):
+    """
+    Pages sharing navigation menus (some with an item changed), a head of links and meta tags,
+    scripts and footers, some with PHP code. Ten pages are enough for the worker pool.
+    """
+    rnd = random.Random(seed)
+    menus = [rnd.sample(WORDS, 6) for _ in range(3)]
+    files = {}
+    for page in range(pages):
+        items = list(rnd.choice(menus))
+        if rnd.random() < 0.4:
+            items[rnd.randrange(6)] = rnd.choice(WORDS)
+        nav = '<nav class="menu"><ul>' + ''.join(
+            '<li><a href="{}.php">{}</a></li>'.format(item, item.title()) for item in items) + '</ul></nav>'
+        head = ('<head>\n<link href="/css/style.css" rel="stylesheet"/>\n<link href="/css/responsive.css" rel="stylesheet"/>\n'
+                '<link href="/images/favicon.ico" rel="icon"/>\n<meta charset="utf-8"/>\n'
+                '<meta content="width=device-width" name="viewport"/>\n<title>Page {}</title>\n</head>'.format(page))
+        footer = '<footer><p>Copyright Example {}</p><a href="privacy.php">Privacy</a></footer>'.format(rnd.randrange(2))
+        script = '<script src="/js/app{}.js?v=<?= $version ?>"></script>'.format(rnd.randrange(2))
+        body = '<div class="content"><p>Page {} <?php echo $visits; ?></p></div>'.format(page)
+        files['page{}.php'.format(page)] = '<!DOCTYPE html>\n<html>{}<body>\n{}\n{}\n{}\n{}\n</body></html>\n'.format(
+            head, nav, body, script, footer)
+    return files
+
+
+def old_are_adjacent_siblings(elem1, elem2):
+    # Before comparing by identity: the next non-whitespace sibling is compared with ==
+    next_sibling = elem1.next_sibling
+    while next_sibling and isinstance(next_sibling, str) and next_sibling.strip() == '':
+        next_sibling = next_sibling.next_sibling
+    return next_sibling == elem2
+
+
+def in_process_map(func, items):
+    return map(func, items)
+
+
+class PHPRefactorTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.tmp = self._tmp.name
+
+    def refactor(self, name, files, **kwargs):
+        root = os.path.join(self.tmp, name)
+        write_tree(root, files)
+        refactor = PHPRefactor(root, **kwargs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            refactor.scan_directory()
+        return refactor
+
+    def common_blocks(self, refactor):
+        with contextlib.redirect_stdout(io.StringIO()):
+            refactor.identify_common_blocks()
+        return {block_id: [(os.path.basename(block['file']), block['content']) for block in blocks]
+                for block_id, blocks in refactor.common_blocks.items()}
+
+    def test_extraction_matches_full_parse(self):
+        for seed in range(5):
+            for content in make_site(seed).values():
+                blocks, messages = extract_potential_blocks(content, 30)
+                with mock.patch.object(php_refactor, '_BLOCK_STRAINER', None), \
+                        mock.patch.object(php_refactor, 'are_adjacent_siblings', old_are_adjacent_siblings):
+                    self.assertEqual(extract_potential_blocks(content, 30), (blocks, messages))
+
+    def test_common_blocks_match_full_parse(self):
+        for seed in range(5):
+            files = make_site(seed)
+            for threshold in (0.5, 0.8, 0.9, 1.0):
+                expected = self.refactor('full', files, min_block_size=30, similarity_threshold=threshold)
+                with mock.patch.object(php_refactor, '_BLOCK_STRAINER', None), \
+                        mock.patch.object(php_refactor, 'are_adjacent_siblings', old_are_adjacent_siblings), \
+                        mock.patch.object(php_refactor, 'map_files', in_process_map):
+                    expected = self.common_blocks(expected)
+                actual = self.refactor('strained', files, min_block_size=30, similarity_threshold=threshold)
+                self.assertEqual(self.common_blocks(actual), expected)
+
+    def test_parallel_rewrite_matches_in_process_rewrite(self):
+        for seed in range(3):
+            files = make_site(seed)
+            sequential = self.refactor('sequential{}'.format(seed), files)
+            with mock.patch.object(php_refactor, 'map_files', in_process_map), \
+                    contextlib.redirect_stdout(io.StringIO()) as expected_output:
+                sequential.run()
+            parallel = self.refactor('parallel{}'.format(seed), files)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                parallel.run()
+            self.assertEqual(read_tree(parallel.directory), read_tree(sequential.directory))
+            self.assertEqual(output.getvalue().replace('parallel', 'sequential'), expected_output.getvalue())
+
+    def test_includes_keep_php_code(self):
+        refactor = self.refactor('site', make_site(0))
+        with contextlib.redirect_stdout(io.StringIO()):
+            refactor.run()
+        files = read_tree(refactor.directory)
+        scripts = [content for name, content in files.items() if name.startswith('includes/script_')]
+        self.assertTrue(scripts)
+        for content in scripts:
+            self.assertIn('?v=<?= $version ?>"', content)
+        for name, content in files.items():
+            if not name.startswith('includes/'):
+                self.assertIn('<?php echo $visits; ?>', content)
+
+
+MENU = ('<nav class="menu"><ul><li><a href="/">Home</a></li><li><a href="/about">About</a></li>'
+        '<li><a href="/contact">Contact</a></li></ul></nav>')
+INCLUDE = "<?php include 'includes/navigation.php'; ?>\n"
+
+# The same links in a main menu and, further down, in a footer menu with one more link
+PAGE = ("<html><body>\n"
+        "<div class='menu'><ul><li><a href='/'>Home</a></li><li><a href='/about'>About</a></li>"
+        "<li><a href='/contact'>Contact</a></li></ul></div>\n"
+        "<p>Text <?php echo $text; ?></p>\n"
+        "<ul class='footer-nav'><li><a href='/'>Home</a></li><li><a href='/about'>About</a></li>"
+        "<li><a href='/contact'>Contact</a></li><li><a href='/privacy'>Privacy</a></li></ul>\n"
+        "</body></html>\n")
+MAIN_MENU = PAGE[PAGE.index("<div class='menu'>"):PAGE.index('</div>') + len('</div>')]
+
+
+class FileRewriterTest(unittest.TestCase):
+    def apply(self, content, block_type='navigation', block=MENU):
+        rewriter = FileRewriter('page.php', content)
+        replaced = rewriter.apply_block('navigation_0', block_type, block, INCLUDE)
+        return replaced, rewriter.content, rewriter.messages
+
+    def test_exact_match(self):
+        replaced, content, messages = self.apply('<body>\n' + MENU + '\n</body>')
+        self.assertTrue(replaced)
+        self.assertEqual(content, '<body>\n' + INCLUDE + '\n</body>')
+        self.assertEqual(messages, ['Replaced block in page.php (exact match)'])
+
+    def test_menu_is_matched_in_document_order(self):
+        replaced, content, messages = self.apply(PAGE)
+        self.assertTrue(replaced)
+        self.assertEqual(content, PAGE.replace(MAIN_MENU, INCLUDE))
+        self.assertEqual(messages, ['Replaced block in page.php (menu content match, ratio: 1.00)'])
+
+    def test_menu_is_matched_in_xhtml(self):
+        declaration = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                       '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"'
+                       ' "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n')
+        replaced, content, _ = self.apply(declaration + PAGE)
+        self.assertTrue(replaced)
+        self.assertEqual(content, declaration + PAGE.replace(MAIN_MENU, INCLUDE))
+
+    def test_menu_with_php_code(self):
+        # Markup written by PHP code is not counted when the menu is located in the source
+        page = PAGE.replace("<li><a href='/contact'>", "<?php echo '<li>'; ?><li><a href='/contact'>", 1)
+        replaced, content, _ = self.apply(page)
+        self.assertTrue(replaced)
+        main_menu = page[page.index("<div class='menu'>"):page.index('</div>') + len('</div>')]
+        self.assertEqual(content, page.replace(main_menu, INCLUDE))
+
+    def test_script_with_php_code(self):
+        script = '<script src="/js/app.js?v=<?= $version ?>" type="text/javascript"></script>'
+        other = '<script src="/js/app.js?v=<?= $version ?>" type="text/javascript">init();</script>'
+        page = '<html><head>\n' + other + '\n</head></html>'
+        replaced, content, messages = self.apply(page, 'script', script)
+        self.assertTrue(replaced)
+        self.assertEqual(content, page.replace(other, INCLUDE))
+        self.assertEqual(messages, ['Replaced block in page.php (script match)'])
+
+
+if __name__ == '__main__':
+    unittest.main()